@@ -23,6 +23,28 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def run_analyzers(analyzers, app_id):
+	"""Run every analyzer on app_id, which you MUST have locked.
+
+	Analyzers that trip over slimit or badly encoded JSON get a
+	FailureReport instead of their report.
+
+	Returns { analyzer class name: report }.
+	"""
+	reports = {}
+	for analyzer in analyzers:
+		report_name = analyzer.__class__.__name__
+		try:
+			reports[report_name] = analyzer.analyze(app_id)
+		except TypeError, e:
+			logger.exception('TypeError during analyzing, possible issue is due to regex parsing failure in the slimit lexer')
+			reports[report_name] = FailureReport(report_type=report_name, message=unicode(e))
+		except UnicodeDecodeError, e:
+			logger.exception('UnicodeDecodeError during analyzing, possibly due to incorrectly encoded JSON')
+			reports[report_name] = FailureReport(report_type=report_name, message=unicode(e))
+	return reports
+
+
 class BaseAnalyzer(object):
 	__metaclass__ = ABCMeta
 
@@ -220,6 +242,9 @@ class MaliciousFlowAnalyzer(BaseAnalyzer):
 class JSUnpackAnalyzer(BaseAnalyzer):
 	"""Analyzer that uses the jsunpack-n program to check for
 	malicious Javascript and URLs with malicious JavaScript.
+
+	With a BlobStore, results are cached per unique file, so a library
+	that many apps ship is only scanned once.
 	"""
 
 	nice = '15'
@@ -233,8 +258,9 @@ class JSUnpackAnalyzer(BaseAnalyzer):
 		'-a' # Follow URLs that are found
 	]
 
-	def __init__(self, git_dir, alphabet=AlphabetType.en_US):
+	def __init__(self, git_dir, alphabet=AlphabetType.en_US, blob_store=None):
 		super(JSUnpackAnalyzer, self).__init__(git_dir, alphabet)
+		self.blob_store = blob_store
 
 	def scan_url(self, url, return_key='web_url'):
 		"""Scans an URL for malicious JS using jsunpackn.
@@ -270,6 +296,9 @@ class JSUnpackAnalyzer(BaseAnalyzer):
 		Return value is a dict in the form of:
 			js_filename: path_to_file,
 			analysis: jsunpack_results
+
+		If the scan timed out, analysis only holds what was found up
+		to then and timed_out is set to True.
 		"""
 		slice_off = len(base_app_dir) + 1
 		if not base_app_dir:
@@ -289,7 +318,30 @@ class JSUnpackAnalyzer(BaseAnalyzer):
 			p.wait()
 		except TimeoutException, e:
 			logger.error('Took way too long to scan a single JS file: %s' % js_fn, e)
+			result['timed_out'] = True
+
+		return result
 
+	def scan_js_cached(self, js_fn, base_app_dir, digest):
+		"""scan_js, reusing the analysis of the blob digest if it was
+		scanned before.
+		"""
+		if not digest:
+			return self.scan_js(js_fn, base_app_dir)
+
+		analysis = self.blob_store.get_result(self.__class__.__name__, digest)
+		if analysis is not None:
+			logger.info('Reusing analysis of blob %s' % digest)
+			return {
+				'js_fn': os.path.relpath(js_fn, base_app_dir),
+				'analysis': analysis
+			}
+
+		result = self.scan_js(js_fn, base_app_dir)
+		# A partial analysis would become the answer for every app with
+		# this blob, so it is scanned again next time instead
+		if not result.get('timed_out'):
+			self.blob_store.put_result(self.__class__.__name__, digest, result['analysis'])
 		return result
 
 	def analyze(self, app_id):
@@ -305,13 +357,18 @@ class JSUnpackAnalyzer(BaseAnalyzer):
 
 		report.requested_permissions.update(bootstrap.perms)
 
+		digests = {}
+		if self.blob_store:
+			digests = self.blob_store.digests(app_id)
+
 		# Iterate over every javascript file
 		for root, dirs, files in os.walk(bootstrap.app_dir):
 			for f in files:
 				if f.endswith('.js'):
 					full_path = os.path.join(root, f)
 					logger.info('Scanning %s' % f)
-					report.results.append(self.scan_js(full_path, bootstrap.app_dir))
+					digest = digests.get(os.path.relpath(full_path, bootstrap.app_dir).replace(os.sep, '/'))
+					report.results.append(self.scan_js_cached(full_path, bootstrap.app_dir, digest))
 
 		# Perform extra analysis for hosted apps that have a web_url
 		if report.web_url:
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os
+import argparse, json, logging
+import demjson
+from timeit import default_timer
+
+import config_utils
+from dao.dictsearchstore import DictionaryAttackKeyValue
+from crawler.discoverer import WebStoreDiscoverer, WebStoreParser
+from crawler.fetcher import MetadataFetcher
+from crawler.http_session import session_from_config
+
+
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(description='benchmarks against recorded web store pages')
+subparsers = parser.add_subparsers(dest='command')
+
+record_parser = subparsers.add_parser('record', help='record search pages from crawl_point to disk')
+record_parser.add_argument('config', help='path to configuration file')
+record_parser.add_argument('out_dir', help='directory to write recorded pages to')
+record_parser.add_argument('--phrase', default='a', help='phrase to search for, default=a')
+record_parser.add_argument('--pages', default=5, type=int, help='number of pages to record, default=5')
+
+search_parser = subparsers.add_parser('search-parse', help='compare demjson with WebStoreParser on recorded search pages')
+search_parser.add_argument('pages', nargs='+', help='recorded search page files')
+search_parser.add_argument('--repeat', default=20, type=int, help='times to parse each page, default=20')
+
+record_detail_parser = subparsers.add_parser('record-detail', help='record app detail pages to disk')
+record_detail_parser.add_argument('config', help='path to configuration file')
+record_detail_parser.add_argument('out_dir', help='directory to write recorded pages to')
+record_detail_parser.add_argument('app_ids', nargs='+', help='app ids to record the detail pages of')
+
+metadata_parser = subparsers.add_parser('metadata', help='compare the legacy and single pass detail page metadata parsers')
+metadata_parser.add_argument('pages', nargs='+', help='recorded detail page files, named <app_id>.html')
+metadata_parser.add_argument('--repeat', default=20, type=int, help='times to parse each page, default=20')
+
+
+def time_call(fn, arg, repeat):
+	"""Best-of-repeat wall time of fn(arg), in milliseconds."""
+	best = None
+	for i in range(repeat):
+		start = default_timer()
+		fn(arg)
+		elapsed = default_timer() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best * 1000
+
+
+def legacy_decode(body):
+	return demjson.decode(body[4:])[0]
+
+
+def record(args):
+	config = {}
+	with open(args.config, 'r') as f:
+		config = json.loads(f.read())
+
+	if not os.path.exists(args.out_dir):
+		os.makedirs(args.out_dir)
+
+	discoverer = WebStoreDiscoverer(None, url=config['crawl_point'], db=None,
+									session=session_from_config(config))
+	dak = DictionaryAttackKeyValue(phrase=args.phrase)
+
+	for page in range(args.pages):
+		url, data = discoverer.build_crawl_url(dak)
+		discoverer.rate_limiter.acquire()
+		body = discoverer.post_request(url, data).content
+
+		out_path = os.path.join(args.out_dir, '%s-%03d.txt' % (args.phrase, page))
+		with open(out_path, 'wb') as f:
+			f.write(body)
+		print 'Recorded %s' % out_path
+
+		parse_result = discoverer.parser.parse_body(body)
+		discoverer.url_params['token'] = '@'.join(parse_result.token)
+
+
+def search_parse(args):
+	web_store_parser = WebStoreParser()
+	legacy_total = 0
+	fast_total = 0
+
+	print '%-40s %12s %12s %8s' % ('page', 'demjson ms', 'parser ms', 'speedup')
+	for page in args.pages:
+		with open(page, 'rb') as f:
+			body = f.read()
+
+		# Both decoders must agree on what matters to the crawler
+		legacy = legacy_decode(body)
+		fast = web_store_parser.decode(body)[0]
+		legacy_ids = [ x[0] for x in legacy[1][1] ]
+		fast_ids = [ x[0] for x in fast[1][1] ]
+		if legacy_ids != fast_ids or legacy[1][4] != fast[1][4]:
+			raise ValueError('Decoders disagree on app ids or token for %s' % page)
+
+		legacy_ms = time_call(legacy_decode, body, args.repeat)
+		fast_ms = time_call(web_store_parser.decode, body, args.repeat)
+		legacy_total += legacy_ms
+		fast_total += fast_ms
+		print '%-40s %12.3f %12.3f %7.1fx' % (os.path.basename(page), legacy_ms, fast_ms, legacy_ms / fast_ms)
+
+	count = len(args.pages)
+	print '%-40s %12.3f %12.3f %7.1fx' % ('mean per page', legacy_total / count, fast_total / count, legacy_total / fast_total)
+	print 'Decode paths used: %s' % dict(web_store_parser.stats)
+
+
+def record_detail(args):
+	config = {}
+	with open(args.config, 'r') as f:
+		config = json.loads(f.read())
+
+	if not os.path.exists(args.out_dir):
+		os.makedirs(args.out_dir)
+
+	fetcher = MetadataFetcher(base_url=config['detail_page'], session=session_from_config(config))
+	for app_id in args.app_ids:
+		out_path = os.path.join(args.out_dir, '%s.html' % app_id)
+		with open(out_path, 'wb') as f:
+			f.write(fetcher.get_app_page(app_id))
+		print 'Recorded %s' % out_path
+
+
+def metadata(args):
+	fetcher = MetadataFetcher(base_url='')
+	legacy_total = 0
+	fast_total = 0
+
+	print '%-40s %12s %12s %8s' % ('page', 'legacy ms', 'parser ms', 'speedup')
+	for page in args.pages:
+		with open(page, 'rb') as f:
+			body = f.read()
+		app_id = os.path.splitext(os.path.basename(page))[0]
+
+		# Equivalence check, everything but the crawl time must match
+		legacy = vars(fetcher.parse_tags_legacy(app_id, body))
+		fast = vars(fetcher.parse_tags(app_id, body))
+		for field in set(legacy) | set(fast):
+			if field != 'crawl_time' and legacy.get(field) != fast.get(field):
+				raise ValueError('Parsers disagree on %s for %s: %r != %r'
+								 % (field, page, legacy.get(field), fast.get(field)))
+
+		legacy_ms = time_call(lambda x: fetcher.parse_tags_legacy(app_id, x), body, args.repeat)
+		fast_ms = time_call(lambda x: fetcher.parse_tags(app_id, x), body, args.repeat)
+		legacy_total += legacy_ms
+		fast_total += fast_ms
+		print '%-40s %12.3f %12.3f %7.1fx' % (os.path.basename(page), legacy_ms, fast_ms, legacy_ms / fast_ms)
+
+	count = len(args.pages)
+	print '%-40s %12.3f %12.3f %7.1fx' % ('mean per page', legacy_total / count, fast_total / count, legacy_total / fast_total)
+
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	if args.command == 'record':
+		record(args)
+	elif args.command == 'search-parse':
+		search_parse(args)
+	elif args.command == 'record-detail':
+		record_detail(args)
+	elif args.command == 'metadata':
+		metadata(args)
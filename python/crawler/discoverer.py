@@ -4,12 +4,17 @@
 import sys
 sys.path.append("..")
 
-import urllib2, collections, urlparse, demjson
+import collections, urlparse, demjson, json, re
 from urllib import urlencode
-import time
+import time, threading, Queue
 import config_utils
 
 from dao.dictsearchstore import *
+from dao.appmetastore import SearchItemMetadata, AppMetadataStore
+from dao.bloomfilter import KnownAppIdFilter
+from synchronization.ratelimit import TokenBucket
+from synchronization.sharding import shard_for
+from crawler.http_session import HttpSession
 import logging
 
 
@@ -26,19 +31,81 @@ class WebStoreParseResult:
 		self.versionresponse = None
 		self.getitemsresponse = []
 		self.app_meta = {}
+		self.app_records = {}
 		self.token = None
 
 
 class WebStoreParser:
+	"""Parser for the getitemsresponse payload of crawl_point.
 
-	def __init__(self):
-		pass
+	The payload is JSON behind an XSSI guard, except that the store
+	sometimes leaves array slots empty (e.g. [1,,2]) the way
+	JavaScript allows. Payloads are decoded with the C accelerated
+	json module first, then with empty slots filled in as null, and
+	only handed to the pure Python demjson decoder if both fail.
+	"""
+
+	XSSI_PREFIX = ")]}'"
+
+	# Either a string literal, which is skipped over, or a '[' or ','
+	# followed by another ',' or ']' (an empty array slot)
+	ELISION_RE = re.compile(r'("(?:[^"\\]|\\.)*")|([\[,])(?=\s*([,\]]))')
+
+	def __init__(self, item_fields=None):
+		self.decoder = json.JSONDecoder(strict=False)
+		self.stats = collections.Counter()
+		self.item_fields = item_fields
+
+	@staticmethod
+	def __fill_elision(match):
+		string, opener, following = match.groups()
+		if string:
+			return string
+		if opener == '[':
+			# '[]' is just an empty array, '[,' starts with a hole
+			return '[' if following == ']' else '[null'
+		# ',,' is a hole, ',]' is a trailing comma
+		return ',null' if following == ',' else ''
+
+	def fill_elisions(self, payload):
+		"""Replace empty array slots with null so that payload is
+		strict JSON.
+		"""
+		return self.ELISION_RE.sub(self.__fill_elision, payload)
+
+	def decode(self, body):
+		"""Decode a raw crawl_point response body."""
+		start = 0
+		if body.startswith(self.XSSI_PREFIX):
+			start = len(self.XSSI_PREFIX)
+		start = body.find('[', start)
+		if start == -1:
+			raise ValueError('Response body is not a JSON array: %r' % body[:100])
+
+		try:
+			decoded = self.decoder.raw_decode(body, start)[0]
+			self.stats['json'] += 1
+			return decoded
+		except ValueError:
+			pass
+
+		payload = body[start:]
+		try:
+			decoded = self.decoder.decode(self.fill_elisions(payload))
+			self.stats['elisions'] += 1
+			return decoded
+		except ValueError:
+			logger.info('Falling back to demjson for non-strict response')
+
+		self.stats['demjson'] += 1
+		return demjson.decode(payload)
 
 	def parse_getitemsresponse(self, parse_result):
 		# Get application id and metadata to put into dict.
 		# The key is the app id, the value is the entire metadata chunk.
 		for x in parse_result.getitemsresponse[1]:
 			parse_result.app_meta[x[0]] = x
+			parse_result.app_records[x[0]] = SearchItemMetadata.from_search_item(x, self.item_fields)
 
 		# Get the "token" value to know what our next request index is.
 		parse_result.token = parse_result.getitemsresponse[4].split('@')
@@ -46,8 +113,11 @@ class WebStoreParser:
 		assert len(parse_result.token) == 2
 
 	def parse(self, response):
+		return self.parse_body(response.content)
+
+	def parse_body(self, body):
 		parse_result = WebStoreParseResult()
-		deserialized_resp = demjson.decode(response.read()[4:])[0]
+		deserialized_resp = self.decode(body)[0]
 
 		parse_result.versionresponse = deserialized_resp[0][1]
 		parse_result.getitemsresponse = deserialized_resp[1]
@@ -58,6 +128,9 @@ class WebStoreParser:
 
 class WebStoreDiscoverer(object):
 
+	# The store stops returning results past this index
+	RESULT_CAP = 900
+
 	def reset_url_params(self):
 		self.url_params = collections.OrderedDict([
 			('hl', 'en-US'),
@@ -74,18 +147,37 @@ class WebStoreDiscoverer(object):
 			('rt', 'j')
 		])
 
-	def __init__(self, dict_store, url, db):
-		self.alphabets = [ AlphabetType.en_US ]
+	def __init__(self, dict_store, url, db, rate_limiter=None, session=None, item_fields=None,
+				 expansion_suffixes=None, max_phrase_length=6, known_filter=None, stream=AlphabetType.en_US,
+				 frontier_shards=0, metadata_max_age=None):
+		self.stream = CrawlStream.of(stream)
+		self.metadata_max_age = metadata_max_age
+		self.frontier_shards = frontier_shards
+		self.alphabets = [ self.stream.alphabet ]
 		self.dict_store = dict_store
 		self.crawl_point = url
 		self.reset_url_params()
-		self.parser = WebStoreParser()
+		self.parser = WebStoreParser(item_fields)
 		self.dak = None
 		self.db = db
+		self.meta_store = AppMetadataStore(db)
+		self.known_filter = known_filter
+
+		# Default pacing matches the old fixed 3 second sleep per page
+		if not rate_limiter:
+			rate_limiter = TokenBucket(rate=1/3.0, capacity=1)
+		self.rate_limiter = rate_limiter
+		self.session = session or HttpSession()
+
+		# Saturated phrases are expanded by appending each of these
+		self.expansion_suffixes = expansion_suffixes
+		self.max_phrase_length = max_phrase_length
 
 	def __get_next_dak(self, alphabet):
 		dak = self.dict_store.get_next(alphabet)
 		logger.info('Got: %s' % dak)
+		if not dak:
+			return None
 		return DictionaryAttackKeyValue.deserialize(dak)
 
 	def __return_dak(self, dak):
@@ -93,24 +185,46 @@ class WebStoreDiscoverer(object):
 		logger.info('Returned: %s' % dak.to_value())
 
 	def build_crawl_url(self, dak):
-		"""Returns (url, data) for the given dak."""
+		"""Returns (url, data) for the given dak, searching in the
+		language, category and sort order of its stream.
+		"""
 		self.url_params['searchTerm'] = dak.phrase
+		self.url_params['hl'] = dak.alphabet.hyphenated()
+		self.url_params['gl'] = dak.alphabet.name.split('_')[-1]
+		self.url_params['category'] = dak.category
+		self.url_params['sortBy'] = dak.sort_by
 		return (self.crawl_point, urlencode(self.url_params))
 
 	def post_request(self, url, data):
 		"""Simple wrapper to POST (url, data). Returns response."""
-		request = urllib2.Request(url, data, headers=config_utils.HTTP_HEADERS)
-		return urllib2.urlopen(request)
+		return self.session.post(url, data, headers=config_utils.HTTP_HEADERS)
 
-	def record_new_app_ids(self, app_meta):
+	def record_new_app_ids(self, app_meta, app_records=None):
 		"""Store the app ids we've crawled into a persistent hash.
 
 		The point of this is to keep track of how many unique
-		app ids we've come across.
+		app ids we've come across. If app_records is given and
+		metadata_max_age is set, the harvested metadata of new apps,
+		and of apps whose record is more than half of metadata_max_age
+		old, is written in the same pipeline.
+
+		With a known_filter, app ids that are probably already in the
+		hash are not sent to Redis at all.
+
+		Returns the hsetnx results of the app ids that were sent.
 		"""
+		app_ids = app_meta.keys()
+		known_filter = self.known_filter
+		if known_filter and known_filter.alphabet == self.dak.alphabet:
+			app_ids = known_filter.filter_new(app_ids)
+		else:
+			known_filter = None
+		# Without a filter, every app id looks new
+		records = self.records_to_refresh(app_ids if known_filter else [], app_records or {})
+
 		# TODO: Replace with abstracted out AppKeyValueStore
 		with self.db.pipeline() as pipe:
-			for app_id in app_meta.keys():
+			for app_id in app_ids:
 				list_name = self.dak.alphabet.name
 
 				# Add app_id with timestamp of when it was
@@ -118,26 +232,74 @@ class WebStoreDiscoverer(object):
 				pipe.hsetnx(list_name, app_id, 0)
 				logger.info('Queued pipelined put: %s, %s' % (list_name, app_id))
 
-			return pipe.execute()
+			# New app ids are due for fetching right away
+			for app_id in app_ids:
+				frontier_name = self.dak.alphabet.frontier_name(shard_for(app_id, self.frontier_shards))
+				pipe.execute_command('ZADD', frontier_name, 'NX', 0, app_id)
 
-	def run(self):
-		"""Handles delegation of work to crawl the web store for
-		app ids and metadata.
+			for record in records:
+				self.meta_store.put(record, self.dak.alphabet, pipe)
 
-		This function will get the next DictionaryAttacKeyValue to use
-		to search the Chrome Web Store, and then will return it to the
-		queue when it is done.
+			results = pipe.execute()[:len(app_ids)]
+
+		if known_filter:
+			known_filter.add(app_ids)
+		return results
+
+	def records_to_refresh(self, new_app_ids, app_records):
+		"""The records of app_records worth writing: none unless
+		harvested metadata is reused, otherwise those of new_app_ids
+		and those whose stored copy is missing or half way to stale.
 		"""
-		try:
-			self.dak = self.__get_next_dak(self.alphabets[0])
+		if not self.metadata_max_age or not app_records:
+			return []
+
+		new_app_ids = set(new_app_ids)
+		others = [ app_id for app_id in app_records if app_id not in new_app_ids ]
+		stored = self.meta_store.get_many(others, self.dak.alphabet)
+		return [ record for app_id, record in app_records.items()
+				 if app_id in new_app_ids or app_id not in stored
+				 or not stored[app_id].is_fresh(self.metadata_max_age / 2) ]
+
+	def crawl(self, dak):
+		"""Crawl every page of search results for dak, recording the
+		app ids found along the way.
+
+		When the crawl finishes, the number of previously unseen app
+		ids it found is folded into dak's yield_score for the
+		PhraseScheduler. Returns that number.
 
+		If the crawl runs into RESULT_CAP, the phrase is saturated and
+		longer child phrases are queued so their results are reached.
+
+		After every page, the token of the next page is checkpointed
+		on dak. A crawl of a dak with a token resumes from that page.
+		"""
+		self.dak = dak
+		new_app_ids = 0
+		pages = 0
+		if dak.token:
+			logger.info('Resuming phrase %s from token: %s' % (dak.phrase, dak.token))
+			self.url_params['token'] = dak.token
+
+		try:
 			token_r = 0
-			while not token_r or token_r < 900:
+			while not token_r or token_r < self.RESULT_CAP:
 				url, data = self.build_crawl_url(self.dak)
-				response = self.post_request(url, data)
-
-				parse_result = self.parser.parse(response)
-				self.record_new_app_ids(parse_result.app_meta)
+				self.rate_limiter.acquire()
+				try:
+					response = self.post_request(url, data)
+					parse_result = self.parser.parse(response)
+				except Exception:
+					if dak.token and not pages:
+						# The saved token may have expired, start over next time
+						logger.warn('Could not resume phrase %s, resetting its token' % dak.phrase)
+						dak.token = ''
+					raise
+				pages += 1
+
+				results = self.record_new_app_ids(parse_result.app_meta, parse_result.app_records)
+				new_app_ids += sum(1 for result in results if result)
 				self.url_params['token'] = '@'.join(parse_result.token)
 				logger.info('Next token: %s' % self.url_params['token'])
 				try:
@@ -145,8 +307,267 @@ class WebStoreDiscoverer(object):
 				except ValueError:
 					logger.info('Possibly reached end of results because could not parse token')
 					break
-				time.sleep(3)
+
+				dak.token = self.url_params['token']
+				if not self.dict_store.checkpoint(dak):
+					logger.warn('Lost claim on phrase %s, stopping crawl' % dak.phrase)
+					return new_app_ids
+
+			# Finished, the next crawl starts from the first page
+			dak.token = ''
+			dak.record_yield(new_app_ids)
+			logger.info('Phrase %s found %s new app ids' % (dak.phrase, new_app_ids))
+
+			if token_r >= self.RESULT_CAP:
+				self.expand(dak)
+			return new_app_ids
+		finally:
+			self.reset_url_params()
+			self.dak = None
+
+	def expand(self, dak):
+		"""Queue child phrases of a phrase whose results were cut off
+		at RESULT_CAP. Returns the number of phrases queued.
+		"""
+		if not self.expansion_suffixes:
+			logger.debug('No expansion suffixes, not expanding: %s' % dak.phrase)
+			return 0
+		if len(dak.phrase) >= self.max_phrase_length:
+			logger.warn('Phrase %s is saturated but already at max length %s' % (dak.phrase, self.max_phrase_length))
+			return 0
+
+		logger.info('Phrase %s hit the result cap, expanding' % dak.phrase)
+		return self.dict_store.expand(dak, self.expansion_suffixes)
+
+	def run(self):
+		"""Handles delegation of work to crawl the web store for
+		app ids and metadata.
+
+		This function will get the next DictionaryAttacKeyValue to use
+		to search the Chrome Web Store, and then will return it to the
+		queue when it is done.
+
+		Returns False if there was no DictionaryAttackKeyValue to crawl.
+		"""
+		dak = self.__get_next_dak(self.stream)
+		if not dak:
+			logger.warn('No DictionaryAttackKeyValue available for: %s' % self.stream.name)
+			return False
+
+		try:
+			self.crawl(dak)
+			return True
+		finally:
+			self.__return_dak(dak)
+
+
+class ConcurrentWebStoreDiscoverer(object):
+	"""Runs several WebStoreDiscoverers in threads so that many
+	phrases of one CrawlStream are crawled at once.
+
+	workers is the global limit on phrases being crawled at the same
+	time. Pages of a single phrase are always fetched one after the
+	other, because each page's token comes from the previous page.
+	All workers share one rate limiter, so the total request rate
+	against crawl_point stays within the limiter's budget no matter
+	how many workers there are.
+
+	A dispatcher in the calling thread claims phrases for idle workers
+	and releases finished phrases in batches, one round trip each,
+	and periodically reaps phrases abandoned by crashed crawlers.
+
+	alphabet is the AlphabetType or CrawlStream to crawl.
+	"""
+
+	def __init__(self, dict_store, url, db, workers=4, rate_limiter=None, session=None, item_fields=None,
+				 expansion_suffixes=None, max_phrase_length=6, known_filter=None,
+				 idle_sleep=30, phrase_sleep=0, reap_interval=60, alphabet=AlphabetType.en_US, frontier_shards=0,
+				 metadata_max_age=None):
+		if workers < 1:
+			raise ValueError('ConcurrentWebStoreDiscoverer needs at least one worker: %s' % workers)
+
+		if not rate_limiter:
+			rate_limiter = TokenBucket(rate=1/3.0, capacity=1)
+		if not session:
+			session = HttpSession(pool_per_host=workers)
+
+		self.dict_store = dict_store
+		self.stream = CrawlStream.of(alphabet)
+		self.rate_limiter = rate_limiter
+		self.idle_sleep = idle_sleep
+		self.phrase_sleep = phrase_sleep
+		self.reap_interval = reap_interval
+		self.stop_event = threading.Event()
+		self.todo = Queue.Queue()
+		self.done = Queue.Queue()
+		self.discoverers = [ WebStoreDiscoverer(dict_store, url=url, db=db, rate_limiter=rate_limiter,
+												session=session, item_fields=item_fields,
+												expansion_suffixes=expansion_suffixes,
+												max_phrase_length=max_phrase_length,
+												known_filter=known_filter,
+												stream=self.stream,
+												frontier_shards=frontier_shards,
+												metadata_max_age=metadata_max_age)
+							 for x in range(workers) ]
+		self.threads = []
+		self.busy = 0
+		self.busy_lock = threading.Lock()
+
+	def work(self, discoverer):
+		"""Crawl phrases handed out by the dispatcher until stop() is
+		called.
+		"""
+		while not self.stop_event.is_set():
+			try:
+				dak = self.todo.get(timeout=1)
+			except Queue.Empty:
+				continue
+
+			with self.busy_lock:
+				self.busy += 1
+			try:
+				discoverer.crawl(dak)
+			except Exception:
+				logger.exception('Discoverer worker failed to crawl phrase: %s' % dak.phrase)
+			finally:
+				self.done.put(dak)
+				with self.busy_lock:
+					self.busy -= 1
+
+			if self.phrase_sleep:
+				self.stop_event.wait(self.phrase_sleep)
+
+	def drain(self, q):
+		items = []
+		while True:
+			try:
+				items.append(q.get_nowait())
+			except Queue.Empty:
+				return items
+
+	def release_done(self):
+		"""Return every finished phrase to the queue in one call."""
+		daks = self.drain(self.done)
+		if daks:
+			self.dict_store.release_batch(daks)
+			logger.info('Returned %s phrases' % len(daks))
+
+	def claim(self):
+		"""Claim enough phrases to keep every worker busy.
+
+		Returns the number of phrases claimed.
+		"""
+		with self.busy_lock:
+			idle = len(self.threads) - self.busy - self.todo.qsize()
+		if idle <= 0:
+			return 0
+
+		values = self.dict_store.get_next_batch(self.stream, idle)
+		for value in values:
+			self.todo.put(DictionaryAttackKeyValue.deserialize(value))
+		return len(values)
+
+	def dispatch(self):
+		"""Hand phrases to workers until stop() is called."""
+		last_reap = 0
+		while not self.stop_event.is_set():
+			try:
+				if time.time() - last_reap >= self.reap_interval:
+					self.dict_store.reap(self.stream)
+					last_reap = time.time()
+
+				self.release_done()
+				if not self.claim() and not self.todo.qsize() and not self.busy:
+					logger.warn('No DictionaryAttackKeyValue available for: %s' % self.stream.name)
+					self.stop_event.wait(self.idle_sleep)
+					continue
+			except Exception:
+				logger.exception('Discoverer dispatcher failed')
+			self.stop_event.wait(1)
+
+	def start(self):
+		for i, discoverer in enumerate(self.discoverers):
+			t = threading.Thread(target=self.work, args=(discoverer,), name='discoverer-%s-%s' % (self.stream.name, i))
+			t.daemon = True
+			t.start()
+			self.threads.append(t)
+		logger.info('Started %s discoverer workers for %s' % (len(self.threads), self.stream.name))
+
+	def stop(self):
+		"""Ask workers to stop after their current phrase."""
+		self.stop_event.set()
+
+	def join(self):
+		# Join with a timeout so that KeyboardInterrupt still gets through
+		for t in self.threads:
+			while t.is_alive():
+				t.join(1)
+
+	def shutdown(self):
+		"""Stop and join the workers, then return every phrase that is
+		still held, including the ones nobody started on.
+		"""
+		self.stop()
+		self.join()
+		for dak in self.drain(self.todo):
+			self.done.put(dak)
+		self.release_done()
+
+	def run_forever(self):
+		self.start()
+		try:
+			self.dispatch()
+		finally:
+			self.shutdown()
+
+
+class MultiStreamDiscoverer(object):
+	"""Crawls several CrawlStreams side by side, e.g. every alphabet,
+	or one alphabet in several categories and sort orders.
+
+	Each stream is a ConcurrentWebStoreDiscoverer with its own phrase
+	queues, workers and rate limiter, and its dispatcher runs in its
+	own thread, so a stream that runs dry or gets throttled does not
+	hold up the others.
+
+	Streams of the same alphabet record app ids into the same app
+	hash, and should share one KnownAppIdFilter, so an app id found by
+	several streams is only recorded once.
+	"""
+
+	def __init__(self, discoverers):
+		if not discoverers:
+			raise ValueError('MultiStreamDiscoverer needs at least one stream')
+
+		self.discoverers = discoverers
+		self.threads = []
+
+	def start(self):
+		for discoverer in self.discoverers:
+			discoverer.start()
+			t = threading.Thread(target=discoverer.dispatch, name='dispatcher-%s' % discoverer.stream.name)
+			t.daemon = True
+			t.start()
+			self.threads.append(t)
+		logger.info('Started %s crawl streams: %s' % (len(self.discoverers),
+													  [ discoverer.stream.name for discoverer in self.discoverers ]))
+
+	def stop(self):
+		for discoverer in self.discoverers:
+			discoverer.stop()
+
+	def join(self):
+		# Join with a timeout so that KeyboardInterrupt still gets through
+		for t in self.threads:
+			while t.is_alive():
+				t.join(1)
+
+	def run_forever(self):
+		self.start()
+		try:
+			self.join()
 		finally:
-			if self.dak:
-				self.reset_url_params()
-				self.__return_dak(self.dak)
+			self.stop()
+			self.join()
+			for discoverer in self.discoverers:
+				discoverer.shutdown()
@@ -5,53 +5,291 @@ import sys, os, traceback
 sys.path.append("..")
 
 import collections, shutil
-import urllib2, collections, demjson
+import collections, demjson, struct, zlib, threading
 from urllib import urlencode
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
 from lxml import etree
 from bs4 import BeautifulSoup
 import zipfile
-from sh import git, ErrorReturnCode_1
+from dulwich.repo import Repo
+from dulwich.errors import NotGitRepository
 
 import config_utils
+from crawler.http_session import HttpSession
 from dao.dictsearchstore import *
+from dao.appmetastore import AppMetadataStore
 from synchronization.locking import *
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+CRX_MAGIC = 'Cr24'
+ZIP_MAGIC = 'PK\x03\x04'
+
+
+def crx_zip_offset(fp):
+	"""Read the CRX header at the start of fp and return the offset
+	of the zip archive that follows it.
+
+	Handles CRX2 (public key and signature lengths) and CRX3 (one
+	header length) headers, as well as plain zip files. Raises
+	ValueError for anything else, e.g. an HTML error page.
+	"""
+	fp.seek(0)
+	header = fp.read(16)
+	if header[:4] == ZIP_MAGIC:
+		return 0
+	if len(header) < 12 or header[:4] != CRX_MAGIC:
+		raise ValueError('Not a CRX or zip file, starts with: %r' % header[:16])
+
+	version, = struct.unpack('<I', header[4:8])
+	if version == 2 and len(header) == 16:
+		key_length, signature_length = struct.unpack('<II', header[8:16])
+		return 16 + key_length + signature_length
+	if version == 3:
+		header_length, = struct.unpack('<I', header[8:12])
+		return 12 + header_length
+	raise ValueError('Unsupported CRX version: %s' % version)
+
+
+def file_crc32(path, chunk_size=64 * 1024):
+	"""CRC-32 of the file at path, the way zip entries record it."""
+	crc = 0
+	with open(path, 'rb') as fp:
+		for chunk in iter(lambda: fp.read(chunk_size), ''):
+			crc = zlib.crc32(chunk, crc)
+	return crc & 0xffffffff
+
+
+def zip_entry_path(name):
+	"""The relative path a zip entry name extracts to, or None if
+	nothing is left of it once absolute and parent parts are dropped.
+	"""
+	name = name.replace('\\', '/')
+	parts = [ part for part in name.split('/') if part and part not in ('.', '..') ]
+	if not parts or os.path.splitdrive(parts[0])[0]:
+		return None
+	return os.path.join(*parts)
+
+
+def sync_tree(zf, target_dir, keep=('.git',)):
+	"""Make target_dir hold exactly the files of the open ZipFile zf.
+
+	Files whose size and CRC-32 already match their zip entry are left
+	alone, so their mtimes do not change and git does not rehash them.
+	Changed files are unlinked before writing, so files hardlinked
+	elsewhere are never modified in place. Files that are not in zf
+	are removed first, except for the top level entries named in keep,
+	so a file that became a directory (or the other way around) is out
+	of the way before the new version is written.
+
+	Returns (written, unchanged, removed) counts.
+	"""
+	written = unchanged = removed = 0
+	entries = []
+	for info in zf.infolist():
+		relative = zip_entry_path(info.filename)
+		if relative and not info.filename.endswith('/'):
+			entries.append((relative, info))
+	wanted = set(relative for relative, info in entries)
+
+	for root, dirs, files in os.walk(target_dir, topdown=False):
+		relative_root = os.path.relpath(root, target_dir)
+		if relative_root == '.':
+			files = [ name for name in files if name not in keep ]
+		elif relative_root.split(os.sep)[0] in keep:
+			continue
+
+		for name in files:
+			relative = os.path.normpath(os.path.join(relative_root, name))
+			if relative not in wanted:
+				os.unlink(os.path.join(root, name))
+				removed += 1
+
+		if relative_root != '.' and not os.listdir(root):
+			os.rmdir(root)
+
+	for relative, info in entries:
+		path = os.path.join(target_dir, relative)
+
+		if os.path.isfile(path) and os.path.getsize(path) == info.file_size \
+				and file_crc32(path) == info.CRC & 0xffffffff:
+			unchanged += 1
+			continue
+
+		if os.path.isdir(path):
+			shutil.rmtree(path)
+		elif os.path.lexists(path):
+			os.unlink(path)
+		elif not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+
+		with zf.open(info) as source, open(path, 'wb') as fp:
+			shutil.copyfileobj(source, fp, 64 * 1024)
+		written += 1
+
+	return (written, unchanged, removed)
+
+
+# Every itemprop that AppMetadata.set_itemprop knows about
+ITEMPROPS = frozenset(['name', 'url', 'version', 'price', 'interactionCount',
+					   'operatingSystems', 'ratingValue', 'ratingCount', 'priceCurrency'])
+
+
+class ItempropTarget(object):
+	"""lxml parser target that collects (itemprop, content) of every
+	itemprop meta tag, without building a tree.
+	"""
+
+	def __init__(self):
+		self.items = []
+		self.seen = set()
+		self.head_done = False
+
+	def start(self, tag, attrib):
+		if tag == 'meta' and 'itemprop' in attrib:
+			self.items.append((attrib['itemprop'], attrib.get('content')))
+			self.seen.add(attrib['itemprop'])
+		elif tag == 'body':
+			self.head_done = True
+
+	def end(self, tag):
+		if tag == 'head':
+			self.head_done = True
+
+	def data(self, data):
+		pass
+
+	def close(self):
+		return self.items
+
+	def done(self):
+		"""True once the head is over and every itemprop was seen, so
+		the rest of the page can't change the result.
+		"""
+		return self.head_done and self.seen >= ITEMPROPS
+
+
+def parse_itemprops(page, chunk_size=16 * 1024):
+	"""Returns (itemprop, content) of every itemprop meta tag in the
+	HTML page, in document order.
+
+	The page is fed to the parser in chunks, and parsing stops after
+	the head if every itemprop was found in it.
+	"""
+	target = ItempropTarget()
+	parser = etree.HTMLParser(target=target)
+	for start in xrange(0, len(page), chunk_size):
+		parser.feed(page[start:start + chunk_size])
+		if target.done():
+			break
+	return parser.close()
+
+
 class GitRepositoryHandler(object):
+	"""Commits extracted apps to one git repository per app.
+
+	Objects, commits and tags are written in-process with dulwich, so
+	no git processes are spawned and the working directory of the
+	process is never changed. The repositories are ordinary git
+	repositories that stock git can read.
+
+	Like git's stat cache, only files whose size, inode or mtime no
+	longer match their index entry are read and hashed, so a commit
+	costs the size of what changed rather than the size of the tree.
+
+	Safe to call from many threads at once. Commits to the same
+	directory are serialized by one of a fixed number of striped locks,
+	so commits to different directories rarely wait on each other.
+	"""
 	git_user = "chrome crawler"
 	git_email = "test@test.com"
 
-	def __init__(self):
-		pass
+	def __init__(self, stripes=64):
+		self.locks = [ threading.Lock() for i in range(stripes) ]
 
-	def init_repo(self, dir):
-		os.chdir(dir)
-		git.init()
-		logger.debug("Invoked git init for %s" % dir)
+	def lock_for(self, dir):
+		dir = os.path.abspath(dir)
+		return self.locks[(zlib.crc32(dir) & 0xffffffff) % len(self.locks)]
 
-	def set_config(self):
-		git.config("user.name %s" % self.git_user)
-		git.config("user.email %s" % self.git_email)
+	def init_repo(self, dir):
+		"""Returns the Repo at dir, creating it if there is none."""
+		try:
+			return Repo(dir)
+		except NotGitRepository:
+			logger.debug("Initialized git repository in %s" % dir)
+			return Repo.init(dir)
+
+	def is_modified(self, entry, st, racy):
+		"""True if the file with stat st may differ from its index
+		entry. Files modified no earlier than the index was last written
+		(racy) can't be told apart by stat, so they count as modified.
+		"""
+		# The index keeps (seconds, nanoseconds) once it was read back
+		mtime = entry.mtime[0] + entry.mtime[1] / 1e9 if isinstance(entry.mtime, tuple) else entry.mtime
+		return (entry.size != st.st_size
+				or entry.ino != st.st_ino
+				or abs(mtime - st.st_mtime) > 1e-6
+				or mtime >= racy)
+
+	def changed_paths(self, repo, dir):
+		"""Paths relative to dir that have to be staged: files that are
+		new or whose stat changed, and index entries whose file is gone.
+		"""
+		index = repo.open_index()
+		try:
+			racy = os.stat(repo.index_path()).st_mtime
+		except OSError:
+			racy = 0
+
+		changed = set(path for path in index if not os.path.isfile(os.path.join(dir, path)))
+		for root, dirs, files in os.walk(dir):
+			if '.git' in dirs:
+				dirs.remove('.git')
+			for name in files:
+				path = os.path.relpath(os.path.join(root, name), dir).replace(os.sep, '/')
+				if path not in index or self.is_modified(index[path], os.lstat(os.path.join(root, name)), racy):
+					changed.add(path)
+		return sorted(changed)
 
 	def commit(self, metadata, dir):
-		os.chdir(dir)
+		"""Commit everything in dir, and tag the commit with the app
+		version.
+
+		Returns False if there was nothing to commit.
+		"""
 		logger.info(metadata.to_pretty_value())
-		git.add("--all")
-		try:
-			git.commit("-m %s" % metadata.to_pretty_value())
-			git.tag("%s" % metadata.version.replace('+', 'plus').replace(' ', ''))
-			logger.info('Committed all changes in: %s' % dir)
-			return True
-		except ErrorReturnCode_1:
-			if 'nothing to commit' in traceback.format_exc():
+		with self.lock_for(dir):
+			repo = self.init_repo(dir)
+
+			# Staging a path that no longer exists drops it from the index
+			changed = self.changed_paths(repo, dir)
+			if changed:
+				repo.stage(changed)
+			tree = repo.open_index().commit(repo.object_store)
+
+			try:
+				head = repo[repo.head()]
+			except KeyError:
+				head = None
+			if head and head.tree == tree:
 				logger.info('Nothing to commit')
 				return False
-			else:
-				logger.error(traceback.format_exc())
-				return False
+
+			identity = '%s <%s>' % (self.git_user, self.git_email)
+			commit_id = repo.do_commit(metadata.to_pretty_value(),
+									   committer=identity, author=identity)
+
+			if metadata.version:
+				tag = 'refs/tags/%s' % metadata.version.replace('+', 'plus').replace(' ', '')
+				if tag in repo.refs:
+					logger.warn('Tag %s already exists in %s' % (tag, dir))
+				else:
+					repo.refs[tag] = commit_id
+
+			logger.info('Committed all changes in: %s' % dir)
+			return True
 
 
 class ChromePackageFetcher(object):
@@ -61,6 +299,22 @@ class ChromePackageFetcher(object):
 	- Fetching the crx for the app_id
 	- Fetching metadata for the app_id
 	- Committing the metadata and extracted app to git dir
+
+	Downloads are spooled in memory, or in a temporary file once they
+	are larger than spool_max_size bytes, and extracted from there.
+	The crx is written to crx_dir as well unless keep_crx is turned off.
+
+	With a BlobStore, the extracted files are deduplicated against
+	every other app before they are committed.
+
+	With an HttpCache, apps that were extracted before are downloaded
+	with a conditional request, and a 304 skips the app entirely. The
+	validators of a download are only cached once finish() is told the
+	app made it all the way through, so a version that failed somewhere
+	is downloaded again instead of being skipped forever.
+
+	With a RevisitPolicy, whether each fetched app changed is recorded
+	so that its next revisit can be scheduled.
 	"""
 
 	def reset_url_params(self):
@@ -72,8 +326,16 @@ class ChromePackageFetcher(object):
 			('lang', None)
 		])
 
-	def __init__(self, url, db, git_dir, crx_dir, metadata_fetcher, alphabet=AlphabetType.en_US):
+	def __init__(self, url, db, git_dir, crx_dir, metadata_fetcher, alphabet=AlphabetType.en_US, session=None,
+				 keep_crx=True, spool_max_size=16 * 1024 * 1024, blob_store=None, cache=None,
+				 revisit_policy=None):
+		self.revisit_policy = revisit_policy
+		self.blob_store = blob_store
+		self.cache = cache
+		self.keep_crx = keep_crx
+		self.spool_max_size = spool_max_size
 		self.alphabet = alphabet
+		self.session = session or HttpSession()
 		self.db = db
 		self.fetch_point = url
 		self.reset_url_params()
@@ -82,26 +344,37 @@ class ChromePackageFetcher(object):
 		self.crx_dir = crx_dir
 		self.git_handler = GitRepositoryHandler()
 		self.metadata_fetcher = metadata_fetcher
+		self.pending = {}
+		self.pending_lock = threading.Lock()
 
 	def build_fetch_url(self, app_id):
 		"""Returns download url for the given app_id."""
-		self.url_params['x=id'] = app_id + '&uc'
-		self.url_params['lang'] = self.alphabet.hyphenated()
+		# A copy, so that threads can share this fetcher
+		url_params = collections.OrderedDict(self.url_params)
+		url_params['x=id'] = app_id + '&uc'
+		url_params['lang'] = self.alphabet.hyphenated()
 
 		# Chrome download API is picky about making sure the = in '&x='
 		# is NOT escaped, but urlencode() escapes it. So replace it
-		return '?'.join((self.fetch_point, urlencode(self.url_params).replace('&x%3D', '&x=')))
+		return '?'.join((self.fetch_point, urlencode(url_params).replace('&x%3D', '&x=')))
 
-	def get_request(self, url):
-		"""Simple wrapper to GET url. Returns response."""
-		request = urllib2.Request(url, headers=config_utils.FETCHER_HTTP_HEADERS)
-		return urllib2.urlopen(request)
+	def get_request(self, url, conditional=False):
+		"""Simple wrapper to GET url. Returns a streamed response.
+
+		If conditional, the validators of the last download are sent,
+		and the response may be a 304.
+		"""
+		if conditional:
+			response, body = self.cache.fetch(self.session, url, config_utils.FETCHER_HTTP_HEADERS,
+											  store_body=False, stream=True)
+			return response
+		return self.session.get(url, headers=config_utils.FETCHER_HTTP_HEADERS, stream=True)
 
 	def get_dl_path_from_response(self, app_id, response):
-		"""Given an app_id and urllib2 response, generate the
+		"""Given an app_id and HTTP response, generate the
 		local file name to save the response results to.
 		"""
-		filename = response.geturl().split('/')[-1]
+		filename = response.url.split('/')[-1]
 		app_path = os.path.join(self.crx_dir, app_id, filename)
 
 		if not os.path.exists(os.path.dirname(app_path)):
@@ -113,50 +386,140 @@ class ChromePackageFetcher(object):
 		return os.path.join(self.git_dir, app_id)
 
 	def extract_crx(self, crx_path, app_id):
-		"""Extract crx at crx_path into the configured git directory
-		for this class.
+		"""Extract crx at crx_path, a path or a seekable file object,
+		into the configured git directory for this class.
 
 		Returns the target directory where the crx was extracted.
 		"""
+		if isinstance(crx_path, basestring):
+			with open(crx_path, 'rb') as fp:
+				return self.extract_crx(fp, app_id)
+
+		# zipfile finds the archive behind the header by itself, this
+		# rejects downloads that are not packages before it gets there
+		offset = crx_zip_offset(crx_path)
+		logger.debug('Zip archive of app %s starts at byte %s' % (app_id, offset))
+		crx_path.seek(0)
+
+		# Only files that changed since the last version are rewritten
 		with zipfile.ZipFile(crx_path, 'r') as zf:
 			extract_path = self.get_crx_extract_path(app_id)
-			zf.extractall(extract_path)
-			logger.info('Extracted app %s to %s' % (app_id, extract_path))
+			written, unchanged, removed = sync_tree(zf, extract_path)
+			logger.info('Extracted app %s to %s (%s written, %s unchanged, %s removed)'
+						% (app_id, extract_path, written, unchanged, removed))
 			return extract_path
 
 	def fetch_app(self, app_id):
-		"""Downloads the app_id .crx file to a local location.
+		"""Downloads the app_id .crx file and extracts it.
 
-		Return location of crx, and location of extracted files.
+		Return location of crx (None if keep_crx is off), and
+		location of extracted files (None if nothing was downloaded,
+		including when the crx was not modified).
 		"""
 		dl_url = self.build_fetch_url(app_id)
-		response = self.get_request(dl_url)
-		logger.info('Fetched from url: %s --- response code was: %s' % (dl_url, response.code))
 
-		if response.code != 200:
+		# Only worth asking if the last download is still extracted
+		conditional = bool(self.cache) and os.path.isdir(self.get_crx_extract_path(app_id))
+		response = self.get_request(dl_url, conditional=conditional)
+		logger.info('Fetched from url: %s --- response code was: %s' % (dl_url, response.status_code))
+
+		if response.status_code == 304:
+			response.close()
+			logger.info('App %s not modified since its last download' % app_id)
+			self.observe(app_id, False)
 			return (None, None)
 
-		app_path = self.get_dl_path_from_response(app_id, response)
+		with SpooledTemporaryFile(max_size=self.spool_max_size) as spool:
+			app_path = None
+			try:
+				if response.status_code != 200:
+					return (None, None)
+
+				if self.keep_crx:
+					app_path = self.get_dl_path_from_response(app_id, response)
+
+				# Written once, to the spool and the kept crx together
+				fp = open(app_path, 'wb') if app_path else None
+				try:
+					for chunk in response.iter_content(chunk_size=64 * 1024):
+						spool.write(chunk)
+						if fp:
+							fp.write(chunk)
+				finally:
+					if fp:
+						fp.close()
+						logger.info('Wrote application crx to: %s' % app_path)
+			finally:
+				response.close()
+
+			extract_path = self.extract_crx(spool, app_id)
+			if self.cache:
+				with self.pending_lock:
+					self.pending[app_id] = (dl_url, response)
+			return (app_path, extract_path)
+
+	def record_version(self, app_id, extract_path):
+		"""Remember the manifest version we just downloaded, so that
+		a VersionCheckStage can skip the app until it changes.
+		"""
+		version = self.metadata_fetcher.read_manifest_version(extract_path)
+		if version:
+			self.db.hset(self.alphabet.versions_name(), app_id, version)
+		return version
+
+	def observe(self, app_id, changed):
+		if self.revisit_policy:
+			self.revisit_policy.observe(app_id, changed)
+
+	def finish(self, app_id, succeeded=True):
+		"""Call once app_id is done with, after analysis and storing
+		its reports. The validators of its download are cached if it
+		succeeded. Otherwise they are dropped along with its recorded
+		version, so the next visit downloads and processes it again.
+		"""
+		with self.pending_lock:
+			pending = self.pending.pop(app_id, None)
 
-		with open(app_path, 'wb') as fp:
-			shutil.copyfileobj(response, fp)
-			logger.info('Wrote application crx to: %s' % fp.name)
+		if succeeded:
+			if pending:
+				# Only the validators, the package itself is in git
+				self.cache.put(*pending)
+			return
 
-		return (app_path, self.extract_crx(app_path, app_id))
+		if pending:
+			self.cache.delete(pending[0])
+		self.db.hdel(self.alphabet.versions_name(), app_id)
 
 	def run(self, app_id=None):
-		# Fetch app
-		app_path, extract_path = self.fetch_app(app_id)
-		metadata = None
+		"""Fetch, extract and commit app_id.
 
-		if app_path:
-			# Fetch metadata
-			metadata = self.metadata_fetcher.fetch_tags(app_id)
+		Returns its metadata if a new version was committed, in which
+		case the caller has to call finish() once it is done with it.
+		Otherwise the app is finished here.
+		"""
+		try:
+			# Fetch app
+			app_path, extract_path = self.fetch_app(app_id)
+			metadata = None
+
+			if extract_path:
+				self.record_version(app_id, extract_path)
+
+				if self.blob_store:
+					self.blob_store.index_app(app_id, extract_path)
 
-			# Commit to git repo
-			self.git_handler.init_repo(extract_path)
-			if not self.git_handler.commit(metadata, extract_path):
-				return None
+				# Fetch metadata, from the search results if they are fresh
+				metadata = self.metadata_fetcher.fetch(app_id, extract_path)
+
+				# Commit to git repo
+				committed = self.git_handler.commit(metadata, extract_path)
+				self.observe(app_id, committed)
+				if not committed:
+					self.finish(app_id)
+					return None
+		except Exception:
+			self.finish(app_id, False)
+			raise
 
 		return metadata
 
@@ -164,18 +527,104 @@ class ChromePackageFetcher(object):
 class MetadataFetcher(object):
 	"""Metadata fetching and storing functionality"""
 
-	def __init__ (self, base_url):
+	def __init__ (self, base_url, session=None, meta_store=None, max_record_age=86400000, alphabet=AlphabetType.en_US,
+				  cache=None, rate_limiter=None):
+		"""Initialize the fetcher.
+
+		Keyword arguments:
+		base_url -- Detail page url that app ids are appended to.
+		session -- HttpSession to fetch detail pages with. (default new HttpSession)
+		meta_store -- AppMetadataStore holding metadata harvested by the discoverer. (default None)
+		max_record_age -- Harvested records older than this many ms are ignored. (default 1 day)
+		alphabet -- AlphabetType the harvested records are stored under.
+		cache -- HttpCache to revalidate detail pages with. (default None)
+		rate_limiter -- Token bucket pacing detail page requests. (default None)
+		"""
 		self.base_url = base_url
+		self.session = session or HttpSession()
+		self.meta_store = meta_store
+		self.max_record_age = max_record_age
+		self.alphabet = alphabet
+		self.cache = cache
+		self.rate_limiter = rate_limiter
 
 	def generate_url(self, app_id):
 		return self.base_url + app_id
 
+	def read_manifest_version(self, app_dir):
+		"""Returns the version in app_dir/manifest.json, or None."""
+		try:
+			with open(os.path.join(app_dir, 'manifest.json'), 'r') as f:
+				return json.loads(f.read(), strict=False).get('version')
+		except (IOError, ValueError, AttributeError):
+			logger.exception('Could not read manifest version from %s' % app_dir)
+			return None
+
+	def fetch_record(self, app_id, app_dir):
+		"""Build AppMetadata from the harvested search record for
+		app_id, using the version from the extracted manifest.
+
+		Returns None if there is no fresh record or no version.
+		"""
+		if not self.meta_store or not app_dir:
+			return None
+
+		record = self.meta_store.get(app_id, self.alphabet)
+		if not record or not record.name or not record.is_fresh(self.max_record_age):
+			return None
+
+		version = self.read_manifest_version(app_dir)
+		if not version:
+			return None
+
+		metadata = AppMetadata(app_id)
+		metadata.name = record.name
+		metadata.url = self.generate_url(app_id)
+		metadata.version = version
+		metadata.price = record.price
+		metadata.downloads = record.downloads
+		metadata.rating_value = record.rating_value
+		metadata.rating_count = record.rating_count
+		return metadata
+
+	def fetch(self, app_id, app_dir=None):
+		"""Get metadata for app_id, skipping the detail page if the
+		discoverer harvested a fresh record for it.
+		"""
+		metadata = self.fetch_record(app_id, app_dir)
+		if metadata:
+			logger.info('Using harvested metadata for: %s' % app_id)
+			return metadata
+		return self.fetch_tags(app_id)
+
 	def get_app_page(self, app_id):
-		response = urllib2.urlopen(self.generate_url(app_id))
-		return response.read()
+		if self.rate_limiter:
+			self.rate_limiter.acquire()
+		if self.cache:
+			response, body = self.cache.fetch(self.session, self.generate_url(app_id), config_utils.HTTP_HEADERS)
+			return body
+		response = self.session.get(self.generate_url(app_id), headers=config_utils.HTTP_HEADERS)
+		return response.content
 
 	def fetch_tags(self, app_id):
-		tree = etree.HTML(self.get_app_page(app_id))
+		return self.parse_tags(app_id, self.get_app_page(app_id))
+
+	def parse_tags(self, app_id, page):
+		"""Build AppMetadata from the itemprop meta tags of a detail
+		page, in a single pass of the lxml parser.
+		"""
+		metadata = AppMetadata(app_id)
+		for itemprop, content in parse_itemprops(page):
+			if content is not None:
+				metadata.set_itemprop(itemprop, content)
+		return metadata
+
+	def parse_tags_legacy(self, app_id, page):
+		"""parse_tags the way it used to be done, with an extra
+		BeautifulSoup parse of every meta tag. Only kept to check
+		parse_tags against (see benchmark.py metadata).
+		"""
+		tree = etree.HTML(page)
 		m = tree.xpath("//meta")
 		metadata = AppMetadata(app_id)
 
@@ -183,32 +632,7 @@ class MetadataFetcher(object):
 			if etree.tostring(i).find("itemprop") != -1:
 				soup = BeautifulSoup(etree.tostring(i))
 				for meta_tag in soup('meta'):
-					if meta_tag['itemprop'] == 'name':
-						metadata.name = meta_tag['content']
-					elif meta_tag['itemprop'] == 'url':
-						metadata.url = meta_tag['content']
-					elif meta_tag['itemprop'] == 'version':
-						metadata.version = meta_tag['content']
-					elif meta_tag['itemprop'] == 'price':
-						metadata.price = float(meta_tag['content'][1:])
-					elif meta_tag['itemprop'] == 'interactionCount':
-						if(meta_tag['content'].find("UserDownloads") != -1):
-							downloads = meta_tag['content'][14:].replace(',', '')
-							if downloads.endswith('+'):
-								metadata.downloads = downloads.replace('+', '')
-							else:
-						 		metadata.downloads = int(downloads)
-						else:
-						 	metadata.downloads = 0
-
-					elif meta_tag['itemprop'] == 'operatingSystems':
-						metadata.os = meta_tag['content']
-					elif meta_tag['itemprop'] == 'ratingValue':
-						metadata.rating_value = float(meta_tag['content'])
-					elif meta_tag['itemprop'] == 'ratingCount':
-						metadata.rating_count = int(meta_tag['content'].replace(',', ''))
-					elif meta_tag['itemprop'] == 'priceCurrency':
-						metadata.price_currency = meta_tag['content']
+					metadata.set_itemprop(meta_tag['itemprop'], meta_tag['content'])
 		return metadata
 
 
@@ -237,6 +661,35 @@ class AppMetadata(object):
 
 		return json.dumps(instance_vars, indent=indent, sort_keys=sort_keys)
 
+	def set_itemprop(self, itemprop, content):
+		"""Set the field for one itemprop meta tag of a detail page."""
+		if itemprop == 'name':
+			self.name = content
+		elif itemprop == 'url':
+			self.url = content
+		elif itemprop == 'version':
+			self.version = content
+		elif itemprop == 'price':
+			self.price = float(content[1:])
+		elif itemprop == 'interactionCount':
+			if(content.find("UserDownloads") != -1):
+				downloads = content[14:].replace(',', '')
+				if downloads.endswith('+'):
+					self.downloads = downloads.replace('+', '')
+				else:
+					self.downloads = int(downloads)
+			else:
+				self.downloads = 0
+
+		elif itemprop == 'operatingSystems':
+			self.os = content
+		elif itemprop == 'ratingValue':
+			self.rating_value = float(content)
+		elif itemprop == 'ratingCount':
+			self.rating_count = int(content.replace(',', ''))
+		elif itemprop == 'priceCurrency':
+			self.price_currency = content
+
 	def print_all(self):
 		"""Useful for debugging."""
 		import pprint
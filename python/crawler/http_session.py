@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os, traceback
+sys.path.append("..")
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import logging
+
+import config_utils
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+HTTP_CONFIG_KEY = 'http_config'
+
+
+class HttpSession(object):
+	"""Pooled keep-alive HTTP client shared by the discoverer, the
+	package fetcher and the metadata fetcher.
+
+	Connections are reused per host, so only the first request to a
+	host pays for the TCP and TLS handshake. At most pool_per_host
+	connections are opened to any one host; extra requests block until
+	a connection is free. Failed connections and 5xx responses are
+	retried with exponential backoff.
+
+	Responses are requests.Response objects. Like urllib2.urlopen, a
+	non-2xx final response raises an HTTPError.
+
+	With rate_limiters, the status of every response from a url under
+	one of their prefixes, retried ones included, is reported to that
+	limiter, so adaptive limiters can back off. 5xx responses from urls
+	under an adaptive limiter are not retried here, since every retry
+	would be another request that never took a token from the limiter.
+	"""
+
+	RETRY_STATUSES = (500, 502, 503, 504)
+
+	def __init__(self, timeout=(10, 60), retries=3, backoff=0.5, pool_hosts=10, pool_per_host=8, gzip=True,
+				 rate_limiters=None):
+		"""Initialize the session.
+
+		Keyword arguments:
+		timeout -- (connect, read) timeout in seconds for every request. (default (10, 60))
+		retries -- How many times to retry a failed request. (default 3)
+		backoff -- Backoff factor, retries sleep backoff * 2^(retry - 1) seconds. (default 0.5)
+		pool_hosts -- How many per-host connection pools to keep around. (default 10)
+		pool_per_host -- Maximum open connections to a single host. (default 8)
+		gzip -- Ask for gzip/deflate encoded responses. (default True)
+		rate_limiters -- { url prefix: limiter } to report responses to. (default None)
+		"""
+		self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+		self.gzip = gzip
+		self.rate_limiters = rate_limiters or {}
+
+		def build_adapter(status_forcelist):
+			retry = Retry(total=retries,
+						  backoff_factor=backoff,
+						  status_forcelist=status_forcelist,
+						  method_whitelist=False,
+						  raise_on_status=False)
+			return HTTPAdapter(pool_connections=pool_hosts,
+							   pool_maxsize=pool_per_host,
+							   pool_block=True,
+							   max_retries=retry)
+
+		adapter = build_adapter(self.RETRY_STATUSES)
+		self.session = requests.Session()
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+		# Requests uses the adapter mounted at the longest prefix of a url,
+		# so adaptive endpoints only retry failed connections, and leave
+		# backing off from 5xx responses to their limiter
+		adaptive_prefixes = [ prefix for prefix, limiter in self.rate_limiters.items()
+							  if getattr(limiter, 'adaptive', False) ]
+		if adaptive_prefixes:
+			adaptive_adapter = build_adapter(())
+			for prefix in adaptive_prefixes:
+				self.session.mount(prefix, adaptive_adapter)
+
+	def build_headers(self, headers):
+		"""Copy headers, turning on compression if configured."""
+		headers = dict(headers)
+		if self.gzip:
+			headers['accept-encoding'] = 'gzip, deflate'
+		return headers
+
+	def limiter_for(self, url):
+		"""The rate limiter with the longest prefix of url, or None."""
+		prefixes = [ prefix for prefix in self.rate_limiters if url.startswith(prefix) ]
+		if not prefixes:
+			return None
+		return self.rate_limiters[max(prefixes, key=len)]
+
+	@staticmethod
+	def retry_after(response):
+		"""Seconds in the Retry-After header of response, or None."""
+		try:
+			return int(response.headers.get('retry-after'))
+		except (TypeError, ValueError):
+			return None
+
+	def observe(self, url, response):
+		"""Report the statuses of response, and of the attempts that
+		were retried before it, to the rate limiter for url.
+		"""
+		limiter = self.limiter_for(url)
+		if not limiter:
+			return
+
+		# urllib3 keeps the statuses it retried on in the response's Retry
+		retries = getattr(response.raw, 'retries', None)
+		for attempt in getattr(retries, 'history', ()):
+			if attempt.status:
+				limiter.observe(attempt.status)
+		limiter.observe(response.status_code, self.retry_after(response))
+
+	def request(self, method, url, headers, data=None, stream=False):
+		response = self.session.request(method, url,
+										data=data,
+										headers=self.build_headers(headers),
+										timeout=self.timeout,
+										stream=stream)
+		logger.debug('%s %s --- response code was: %s' % (method, url, response.status_code))
+		self.observe(url, response)
+
+		try:
+			response.raise_for_status()
+		except requests.HTTPError:
+			response.close()
+			raise
+		return response
+
+	def get(self, url, headers=config_utils.FETCHER_HTTP_HEADERS, stream=False):
+		"""GET url. Pass stream=True to read large bodies in chunks."""
+		return self.request('GET', url, headers, stream=stream)
+
+	def post(self, url, data, headers=config_utils.HTTP_HEADERS):
+		"""POST (url, data)."""
+		return self.request('POST', url, headers, data=data)
+
+	def close(self):
+		self.session.close()
+
+
+def session_from_config(config, key=HTTP_CONFIG_KEY, rate_limiters=None):
+	"""Build an HttpSession from the optional http_config section of
+	the configuration file. Missing settings use HttpSession defaults.
+
+	rate_limiters is { endpoint: limiter }, as returned by
+	rate_limiters_from_config. Responses from each endpoint's url are
+	reported to its limiter.
+	"""
+	http_config = config.get(key, {})
+	limiters = dict((config[endpoint], limiter) for endpoint, limiter in (rate_limiters or {}).items())
+	return HttpSession(rate_limiters=limiters, **http_config)
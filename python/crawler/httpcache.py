@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append("..")
+
+import collections, errno, hashlib, json, threading, time
+import logging
+
+import config_utils
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+HTTP_CACHE_CONFIG_KEY = 'http_cache_config'
+
+
+class HttpCache(object):
+	"""On-disk cache of HTTP validators, and optionally bodies, for
+	conditional requests.
+
+	For every cached url, the ETag and Last-Modified of its last 200
+	response are kept, and sent back as If-None-Match and
+	If-Modified-Since. A 304 response means the copy from last time is
+	still current.
+
+	Entries are evicted least recently used first once the cache holds
+	more than max_size bytes. Hits, misses, stores and evictions are
+	counted in stats.
+
+	Entries are spread over 256 subdirectories by the first two hex
+	digits of their key, so no directory grows too large.
+
+	Safe to share between threads, and between processes using the same
+	cache_dir: files are written under a temporary name and renamed into
+	place, so readers never see half of one. The size of the cache is
+	kept as a running count of what this process wrote and removed, and
+	measured from the directory itself, to pick up what other processes
+	did, every measure_interval stores and before evicting.
+	"""
+
+	def __init__(self, cache_dir, max_size=1024 * 1024 * 1024, measure_interval=1000):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		self.measure_interval = measure_interval
+		self.stats = collections.Counter()
+		self.lock = threading.Lock()
+		self.size = None
+		self.unmeasured_stores = 0
+
+		if not os.path.exists(cache_dir):
+			try:
+				os.makedirs(cache_dir)
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise
+
+	def key(self, url):
+		return hashlib.sha1(url).hexdigest()
+
+	def shard_dir(self, key):
+		return os.path.join(self.cache_dir, key[:2])
+
+	def meta_path(self, key):
+		return os.path.join(self.shard_dir(key), key + '.json')
+
+	def body_path(self, key):
+		return os.path.join(self.shard_dir(key), key + '.body')
+
+	def __file_size(self, path):
+		try:
+			return os.path.getsize(path)
+		except OSError:
+			return 0
+
+	def __unlink(self, path):
+		"""Remove path, unless another process already did. Call with
+		the lock held.
+		"""
+		size = self.__file_size(path)
+		try:
+			os.unlink(path)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			return
+		if self.size is not None:
+			self.size -= size
+
+	def __write(self, path, data):
+		"""Replace path with data. Call with the lock held."""
+		if not os.path.isdir(os.path.dirname(path)):
+			try:
+				os.makedirs(os.path.dirname(path))
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise
+
+		replaced = self.__file_size(path)
+		temp_path = '%s.%s.%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+		with open(temp_path, 'wb') as f:
+			f.write(data)
+		os.rename(temp_path, path)
+		if self.size is not None:
+			self.size += len(data) - replaced
+
+	def entry_paths(self):
+		"""Every file in cache_dir, including what other processes
+		wrote.
+		"""
+		for root, dirs, files in os.walk(self.cache_dir):
+			for name in files:
+				yield os.path.join(root, name)
+
+	def disk_size(self):
+		"""Bytes in cache_dir, including what other processes wrote."""
+		return sum(self.__file_size(path) for path in self.entry_paths())
+
+	def __measure(self):
+		self.size = self.disk_size()
+		self.unmeasured_stores = 0
+		return self.size
+
+	def get(self, url):
+		"""Returns the cached entry for url, a dict with the etag,
+		last_modified and stored time, or None.
+		"""
+		path = self.meta_path(self.key(url))
+		try:
+			with open(path, 'rb') as f:
+				entry = json.loads(f.read())
+		except (IOError, ValueError):
+			return None
+
+		# Mark as recently used for eviction
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+		return entry
+
+	def get_body(self, url):
+		"""Returns the cached body of url, or None."""
+		try:
+			with open(self.body_path(self.key(url)), 'rb') as f:
+				return f.read()
+		except IOError:
+			return None
+
+	def conditional_headers(self, url, headers):
+		"""Copy headers, adding the validators cached for url."""
+		headers = dict(headers)
+		entry = self.get(url)
+		if entry:
+			if entry.get('etag'):
+				headers['if-none-match'] = entry['etag']
+			if entry.get('last_modified'):
+				headers['if-modified-since'] = entry['last_modified']
+		return headers
+
+	def put(self, url, response, body=None):
+		"""Cache the validators of response for url, and body if given.
+
+		Responses without validators are not cached. Returns True if
+		an entry was stored.
+		"""
+		etag = response.headers.get('etag')
+		last_modified = response.headers.get('last-modified')
+		if not etag and not last_modified:
+			return False
+
+		key = self.key(url)
+		entry = json.dumps({
+			'url': url,
+			'etag': etag,
+			'last_modified': last_modified,
+			'has_body': body is not None,
+			'stored': config_utils.current_time_millis()
+		})
+
+		with self.lock:
+			# The body goes first, so the validators never outlive it
+			if body is not None:
+				self.__write(self.body_path(key), body)
+			else:
+				self.__unlink(self.body_path(key))
+			self.__write(self.meta_path(key), entry)
+			self.stats['stores'] += 1
+
+			self.unmeasured_stores += 1
+			if self.size is None or self.unmeasured_stores >= self.measure_interval:
+				self.__measure()
+			# Other processes may have evicted meanwhile, so measure again
+			# before evicting anything
+			if self.size > self.max_size and self.__measure() > self.max_size:
+				self.evict()
+		return True
+
+	def delete(self, url):
+		key = self.key(url)
+		with self.lock:
+			self.__unlink(self.meta_path(key))
+			self.__unlink(self.body_path(key))
+
+	def evict(self):
+		"""Delete least recently used entries until the cache is down to
+		90% of max_size. Call with the lock held, right after measuring
+		the size of the cache.
+		"""
+		entries = []
+		for path in self.entry_paths():
+			if path.endswith('.json'):
+				try:
+					entries.append((os.path.getmtime(path), os.path.basename(path)[:-len('.json')]))
+				except OSError, e:
+					# Evicted or replaced by another process meanwhile
+					if e.errno != errno.ENOENT:
+						raise
+		entries.sort()
+
+		target = self.max_size * 0.9
+		for used, key in entries:
+			if self.size <= target:
+				break
+			self.__unlink(self.meta_path(key))
+			self.__unlink(self.body_path(key))
+			self.stats['evictions'] += 1
+
+	def fetch(self, session, url, headers, store_body=True, stream=False):
+		"""GET url with session as a conditional request.
+
+		Returns (response, body). On a 304, response.status_code is 304
+		and body is the cached body (None if bodies aren't stored for
+		url). Otherwise body is the new body, or None with stream, in
+		which case the caller reads response and calls put itself.
+		"""
+		response = session.get(url, headers=self.conditional_headers(url, headers), stream=stream)
+
+		if response.status_code == 304:
+			body = self.get_body(url) if store_body else None
+			if store_body and body is None:
+				# Validators without a body are no use, fetch it again
+				self.delete(url)
+				self.stats['misses'] += 1
+				response = session.get(url, headers=headers, stream=stream)
+			else:
+				self.stats['hits'] += 1
+				logger.info('HTTP cache hit: %s' % url)
+				return (response, body)
+		else:
+			self.stats['misses'] += 1
+
+		if stream:
+			return (response, None)
+
+		body = response.content
+		self.put(url, response, body if store_body else None)
+		return (response, body)
+
+
+def cache_from_config(config, key=HTTP_CACHE_CONFIG_KEY):
+	"""Build an HttpCache from the optional http_cache_config section
+	of the configuration file, or None if there isn't one.
+	"""
+	cache_config = config.get(key)
+	if not cache_config:
+		return None
+	return HttpCache(**cache_config)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append("..")
+
+import functools, multiprocessing, signal, threading, time, Queue
+import logging
+
+from analyzer.single_analyzer import run_analyzers
+from synchronization.ratelimit import TokenBucket
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# The analyzers of an analysis process, built once per process
+worker_analyzers = None
+
+
+def init_analysis_worker(analyzer_factory):
+	global worker_analyzers
+	# Ctrl-C goes to the parent, which shuts the pool down
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	worker_analyzers = analyzer_factory()
+
+
+def analyze_in_worker(app_id):
+	"""Run the analyzers of this process on app_id. Returns the
+	reports, or None if analysis failed.
+	"""
+	try:
+		return run_analyzers(worker_analyzers, app_id)
+	except Exception:
+		logger.exception('Analysis failed for app_id: %s' % app_id)
+		return None
+
+
+class FetchPipeline(object):
+	"""Fetches, analyzes and stores apps in stages that run at the same
+	time, so that the network, the disks and the CPUs are all kept busy.
+
+		claim -> fetch (threads) -> analyze (processes) -> store (threads)
+
+	Fetching (download, extract, metadata and commit) and storing
+	reports wait on I/O, so they run in threads. Analysis is CPU bound,
+	so it runs in a pool of processes. Stages are connected by bounded
+	queues: when a stage falls behind, the stages before it block
+	instead of piling up work, and no more app ids are claimed than the
+	pipeline can hold. Throughput is that of the slowest stage.
+
+	Every app_id is completed in the locker once it leaves the
+	pipeline, whether it made it all the way or not. The fetcher is
+	told which of the two it was.
+
+	Python 2's pool has no error callback, so analyses whose result
+	could not be sent back, or whose process died, are found by polling
+	and given up on after analysis_timeout.
+	"""
+
+	def __init__(self, locker, fetcher, analyzer_factory, store, fetchers=4, analyzers=None, storers=1,
+				 rate_limiter=None, queue_size=None, idle_sleep=3, analysis_timeout=3600):
+		"""Initialize the pipeline.
+
+		Keyword arguments:
+		locker -- ApplicationIdLocker to claim and complete app ids with.
+		fetcher -- ChromePackageFetcher shared by the fetch threads.
+		analyzer_factory -- Callable returning the list of analyzers, called once in each analysis process.
+		store -- ReportStore to put reports into.
+		fetchers -- Number of fetch threads. (default 4)
+		analyzers -- Number of analysis processes. (default number of CPUs)
+		storers -- Number of store threads. (default 1)
+		rate_limiter -- TokenBucket pacing downloads across all fetch threads. (default one every 3 seconds)
+		queue_size -- Bound of each queue between stages. (default twice the next stage's workers)
+		idle_sleep -- Seconds to wait when there are no app ids to claim. (default 3)
+		analysis_timeout -- Seconds after which an analysis that never returned is given up on. (default 3600)
+		"""
+		self.locker = locker
+		self.fetcher = fetcher
+		self.analyzer_factory = analyzer_factory
+		self.store = store
+		self.fetchers = fetchers
+		self.analyzers = analyzers or multiprocessing.cpu_count()
+		self.storers = storers
+		self.idle_sleep = idle_sleep
+		self.analysis_timeout = analysis_timeout
+
+		if not rate_limiter:
+			rate_limiter = TokenBucket(rate=1/3.0, capacity=1)
+		self.rate_limiter = rate_limiter
+
+		self.fetch_queue = Queue.Queue(queue_size or self.fetchers * 2)
+		self.store_queue = Queue.Queue(queue_size or self.storers * 2)
+		self.analysis_slots = threading.Semaphore(queue_size or self.analyzers * 2)
+		# app_id -> (AsyncResult, started) of every analysis in the pool
+		self.analyses = {}
+		self.analyses_lock = threading.Lock()
+
+		self.stop_fetching = threading.Event()
+		self.stop_storing = threading.Event()
+		self.fetch_threads = []
+		self.store_threads = []
+		self.pool = None
+
+	def finish(self, app_id, succeeded=True):
+		try:
+			self.fetcher.finish(app_id, succeeded)
+		except Exception:
+			logger.exception('Could not finish fetching app_id: %s' % app_id)
+		try:
+			self.locker.complete(app_id)
+			logger.info('done with: %s' % app_id)
+		except Exception:
+			logger.exception('Could not complete app_id: %s' % app_id)
+
+	def fetch_worker(self):
+		while not self.stop_fetching.is_set():
+			try:
+				app_id = self.fetch_queue.get(timeout=1)
+			except Queue.Empty:
+				continue
+
+			try:
+				self.rate_limiter.acquire()
+				metadata = self.fetcher.run(app_id)
+			except Exception:
+				logger.exception('Fetch failed for app_id: %s' % app_id)
+				metadata = None
+
+			if not metadata:
+				self.finish(app_id)
+				continue
+
+			# Blocks while the analysis processes are saturated
+			self.analysis_slots.acquire()
+			with self.analyses_lock:
+				self.analyses[app_id] = (self.pool.apply_async(analyze_in_worker, (app_id,),
+															   callback=functools.partial(self.analyzed, app_id, metadata)),
+										 time.time())
+
+	def end_analysis(self, app_id):
+		"""Forget the analysis of app_id and free its slot. Returns
+		False if it was already ended.
+		"""
+		with self.analyses_lock:
+			if self.analyses.pop(app_id, None) is None:
+				return False
+		self.analysis_slots.release()
+		return True
+
+	def analyzed(self, app_id, metadata, reports):
+		"""Runs in the pool's result thread, blocks while the store
+		stage is saturated.
+		"""
+		if self.end_analysis(app_id):
+			self.store_queue.put((app_id, metadata, reports))
+
+	def check_analyses(self):
+		"""Give up on analyses that failed without calling back, or
+		that did not return within analysis_timeout. Returns the
+		number of analyses given up on.
+		"""
+		now = time.time()
+		with self.analyses_lock:
+			analyses = self.analyses.items()
+
+		lost = 0
+		for app_id, (result, started) in analyses:
+			if result.ready():
+				# Successful results call back before they are ready
+				if result.successful():
+					continue
+				try:
+					result.get(0)
+				except Exception:
+					logger.exception('Analysis result lost for app_id: %s' % app_id)
+			elif now - started < self.analysis_timeout:
+				continue
+			else:
+				logger.error('Analysis of app_id %s did not return in %s seconds' % (app_id, self.analysis_timeout))
+
+			if self.end_analysis(app_id):
+				self.finish(app_id, False)
+				lost += 1
+		return lost
+
+	def store_worker(self):
+		while not (self.stop_storing.is_set() and self.store_queue.empty()):
+			try:
+				app_id, metadata, reports = self.store_queue.get(timeout=1)
+			except Queue.Empty:
+				continue
+
+			succeeded = False
+			try:
+				if reports is not None:
+					all_reports = { metadata.__type__: metadata }
+					all_reports.update(reports)
+					self.store.put(all_reports, vars(metadata))
+					succeeded = True
+			except Exception:
+				logger.exception('Store failed for app_id: %s' % app_id)
+			finally:
+				self.finish(app_id, succeeded)
+
+	def claim(self):
+		"""Claim as many app ids as the fetch queue has room for.
+
+		Returns the number of app ids claimed.
+		"""
+		room = self.fetch_queue.maxsize - self.fetch_queue.qsize()
+		if room <= 0:
+			return 0
+
+		app_ids = self.locker.claim(room)
+		for app_id in app_ids:
+			self.fetch_queue.put(app_id)
+		return len(app_ids)
+
+	def start(self):
+		self.pool = multiprocessing.Pool(self.analyzers, init_analysis_worker, (self.analyzer_factory,))
+
+		for i in range(self.storers):
+			t = threading.Thread(target=self.store_worker, name='store-%s' % i)
+			t.daemon = True
+			t.start()
+			self.store_threads.append(t)
+
+		for i in range(self.fetchers):
+			t = threading.Thread(target=self.fetch_worker, name='fetch-%s' % i)
+			t.daemon = True
+			t.start()
+			self.fetch_threads.append(t)
+
+		self.locker.start_heartbeat()
+		logger.info('Started pipeline with %s fetch threads, %s analysis processes and %s store threads'
+					% (self.fetchers, self.analyzers, self.storers))
+
+	def join(self, threads):
+		# Join with a timeout so that KeyboardInterrupt still gets through
+		for t in threads:
+			while t.is_alive():
+				t.join(1)
+
+	def shutdown(self):
+		"""Let every app that was already fetched make it through the
+		pipeline, and hand back the app ids that were claimed but not
+		fetched yet.
+		"""
+		self.stop_fetching.set()
+		self.join(self.fetch_threads)
+
+		unfetched = []
+		while True:
+			try:
+				unfetched.append(self.fetch_queue.get_nowait())
+			except Queue.Empty:
+				break
+		if unfetched:
+			self.locker.release(*unfetched)
+
+		if self.pool:
+			self.pool.close()
+			# A lost analysis would keep join() waiting forever
+			while self.analyses:
+				self.check_analyses()
+				time.sleep(1)
+			self.pool.terminate()
+			self.pool.join()
+
+		self.stop_storing.set()
+		self.join(self.store_threads)
+		self.locker.stop_heartbeat()
+		logger.info('Pipeline shut down')
+
+	def run_forever(self, stop_event=None):
+		"""Run until stop_event is set, then shut down."""
+		if stop_event is None:
+			stop_event = threading.Event()
+
+		self.start()
+		try:
+			while not stop_event.is_set():
+				self.check_analyses()
+				if not self.claim() and self.fetch_queue.empty():
+					stop_event.wait(self.idle_sleep)
+				else:
+					stop_event.wait(0.5)
+		finally:
+			self.shutdown()
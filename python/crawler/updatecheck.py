@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os, traceback
+sys.path.append("..")
+
+from urllib import urlencode, quote
+from lxml import etree
+import logging
+
+import config_utils
+from crawler.http_session import HttpSession
+from dao.dictsearchstore import *
+from synchronization.locking import *
+from synchronization.ratelimit import TokenBucket
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class UpdateChecker(object):
+	"""Asks the update2 endpoint for the current version of many apps
+	in a single request, without downloading any CRX.
+
+	Each app is one x=id%3D<app_id>%26v%3D0.0.0.0%26uc parameter, so
+	the server reports the newest version it has for every app.
+	"""
+
+	def __init__(self, url, session=None, alphabet=AlphabetType.en_US, prodversion='9999.0.9999.0'):
+		self.fetch_point = url
+		self.session = session or HttpSession()
+		self.alphabet = alphabet
+		self.prodversion = prodversion
+
+	def build_check_url(self, app_ids):
+		"""Returns the update check url for all of app_ids."""
+		params = urlencode([
+			('prodchannel', 'unknown'),
+			('prodversion', self.prodversion),
+			('acceptformat', 'crx2,crx3'),
+			('lang', self.alphabet.hyphenated())
+		])
+		apps = ''.join('&x=' + quote('id=%s&v=0.0.0.0&uc' % app_id, safe='')
+					   for app_id in app_ids)
+		return '?'.join((self.fetch_point, params + apps))
+
+	def parse_response(self, body):
+		"""Parse a gupdate XML response into {app_id: version}.
+
+		Apps the server has no update for are mapped to None.
+		"""
+		versions = {}
+		root = etree.fromstring(body)
+
+		for app in root.iter():
+			if not isinstance(app.tag, basestring) or app.tag.split('}')[-1] != 'app':
+				continue
+
+			app_id = app.get('appid')
+			versions[app_id] = None
+			for check in app:
+				if isinstance(check.tag, basestring) and check.tag.split('}')[-1] == 'updatecheck' \
+						and check.get('status') == 'ok':
+					versions[app_id] = check.get('version')
+
+		return versions
+
+	def check(self, app_ids):
+		"""Returns {app_id: version} for app_ids, in one request."""
+		if not app_ids:
+			return {}
+		url = self.build_check_url(app_ids)
+		response = self.session.get(url, headers=config_utils.FETCHER_HTTP_HEADERS)
+		return self.parse_response(response.content)
+
+
+class VersionCheckStage(object):
+	"""Runs ahead of the package fetchers over the due app ids in
+	batches and checks their versions with an UpdateChecker.
+
+	Apps whose version matches the one recorded at their last download
+	are marked as freshly fetched, so only apps that changed (or that
+	were never downloaded) are left for ChromePackageFetcher to pick up.
+	With a RevisitPolicy, unchanged apps are recorded as such, and
+	rescheduled by it.
+
+	Apps left for download are not checked again on later passes until
+	their place in the frontier changes, i.e. until they were fetched
+	and rescheduled. Apps that were never downloaded are left for
+	download without asking the update2 endpoint.
+	"""
+
+	def __init__(self, db, checker, alphabet=AlphabetType.en_US, batch_size=100, rate_limiter=None,
+				 revisit_policy=None, shards=0):
+		self.db = db
+		self.checker = checker
+		self.alphabet = alphabet
+		self.batch_size = batch_size
+		self.revisit_policy = revisit_policy
+		self.shards = shards
+		self.locker = ApplicationIdLocker(db=db, alphabet=alphabet, revisit_policy=revisit_policy, shards=shards)
+		# { app_id: frontier score } of apps left for download
+		self.awaiting_fetch = {}
+
+		if not rate_limiter:
+			rate_limiter = TokenBucket(rate=1/3.0, capacity=1)
+		self.rate_limiter = rate_limiter
+
+	def due_batch(self, offset, shard=None):
+		"""Returns up to batch_size (app id, score) pairs of the due
+		app ids of the frontier, or of one shard of it, skipping the
+		first offset of them.
+		"""
+		return self.db.zrangebyscore(self.alphabet.frontier_name(shard), '-inf',
+									 config_utils.current_time_millis(),
+									 start=offset, num=self.batch_size, withscores=True)
+
+	def check_batch(self, app_ids):
+		"""Check app_ids and mark the unchanged ones as fetched.
+
+		Returns the list of app ids that still need downloading.
+		"""
+		known = dict(zip(app_ids, self.db.hmget(self.alphabet.versions_name(), app_ids)))
+		# Never downloaded, there is nothing to compare with
+		changed = [ app_id for app_id in app_ids if known[app_id] is None ]
+		to_check = [ app_id for app_id in app_ids if known[app_id] is not None ]
+
+		remote = {}
+		if to_check:
+			self.rate_limiter.acquire()
+			remote = self.checker.check(to_check)
+
+		unchanged = []
+		for app_id in to_check:
+			version = remote.get(app_id)
+			if version and version == known[app_id]:
+				unchanged.append(app_id)
+			else:
+				changed.append(app_id)
+		if self.revisit_policy:
+			self.revisit_policy.observe_many(unchanged, False)
+		self.locker.mark_fetched(unchanged)
+
+		logger.info('Version check: %s of %s apps changed' % (len(changed), len(app_ids)))
+		return changed
+
+	def run(self):
+		"""One pass over every due app id.
+
+		Unchanged apps leave the due range as they are marked fetched,
+		so only the changed ones, and the ones still awaiting download
+		since an earlier pass, are skipped over.
+
+		Returns (checked, changed) counts.
+		"""
+		checked = 0
+		changed = 0
+		awaiting_fetch = {}
+		for shard in (range(self.shards) if self.shards else [ None ]):
+			skipped = 0
+			batch = self.due_batch(skipped, shard)
+			while batch:
+				scores = dict(batch)
+				app_ids = [ app_id for app_id, score in batch if self.awaiting_fetch.get(app_id) != score ]
+				for app_id, score in batch:
+					if self.awaiting_fetch.get(app_id) == score:
+						awaiting_fetch[app_id] = score
+
+				left = app_ids
+				if app_ids:
+					try:
+						left = self.check_batch(app_ids)
+						for app_id in left:
+							awaiting_fetch[app_id] = scores[app_id]
+						changed += len(left)
+					except Exception:
+						# Checked again on the next pass
+						logger.exception('Version check failed for batch starting at: %s' % app_ids[0])
+
+				skipped += len(batch) - len(app_ids) + len(left)
+				checked += len(app_ids)
+				batch = self.due_batch(skipped, shard)
+		# Forget apps that were fetched or are no longer due
+		self.awaiting_fetch = awaiting_fetch
+		return (checked, changed)
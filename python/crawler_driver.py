@@ -5,10 +5,14 @@ import redis
 import argparse, json, config_utils
 import time
 
-from dao.dictsearchstore import DictionarySearchStore, DictionaryAttackKeyValue
+from dao.dictsearchstore import DictionarySearchStore, DictionaryAttackKeyValue, CrawlStream
 from crawler.discoverer import *
 from crawler.fetcher import *
 from analyzer.single_analyzer import *
+from synchronization.ratelimit import TokenBucket, rate_limiters_from_config
+from dao.bloomfilter import KnownAppIdFilter
+from crawler.http_session import session_from_config
+from synchronization.sharding import shards_from_config
 
 
 logging.basicConfig(level=logging.INFO)
@@ -17,7 +21,10 @@ logger = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser(description='driver for crawling')
 parser.add_argument('config', help='path to configuration file')
-parser.add_argument('--sleep', default=1, type=float, help='time to sleep in seconds in between dictionary attack keys, default=1')
+parser.add_argument('--sleep', default=0, type=float, help='time to sleep in seconds in between dictionary attack keys per worker, default=0')
+parser.add_argument('--workers', default=1, type=int, help='number of phrases to crawl concurrently per stream, unless set in crawl_streams, default=1')
+parser.add_argument('--rate', default=1/3.0, type=float, help='requests per second allowed against crawl_point across all workers of a stream, unless set in crawl_streams, default=0.33')
+parser.add_argument('--burst', default=1, type=int, help='number of requests that may be sent back to back before rate limiting kicks in, unless set in crawl_streams, default=1')
 
 
 if __name__ == '__main__':
@@ -33,12 +40,49 @@ if __name__ == '__main__':
 	d = DictionarySearchStore(r)
 	app_r = config_utils.redis_from_config(config, key='app_meta_config')
 
+	# Request budgets shared with every other crawler process, if configured
+	rate_limiters = rate_limiters_from_config(config, app_r)
+
+	# Keep-alive connections shared by every worker
+	session = session_from_config(config, rate_limiters=rate_limiters)
+
+	# One crawl stream per alphabet, category and sort order
+	streams = config.get('crawl_streams') or [ {} ]
+	dicts = config['dictionary_config']['dictionaries']
+
+	discoverers = []
+	known_filters = {}
+	for stream_config in streams:
+		stream = CrawlStream.from_config(stream_config)
+
+		# Skip Redis writes for app ids we have already recorded. Streams
+		# of an alphabet share a filter, so they dedupe each other's app ids
+		if not stream.alphabet in known_filters:
+			known_filters[stream.alphabet] = KnownAppIdFilter(app_r, alphabet=stream.alphabet,
+															  **config.get('known_filter_config', {}))
+
+		# Pacing for every worker of the stream, replaces the fixed per-page sleep.
+		# A shared crawl_point limit paces all streams of all processes together
+		rate_limiter = rate_limiters.get('crawl_point') or TokenBucket(rate=stream_config.get('rate', args.rate),
+																		capacity=stream_config.get('burst', args.burst))
+
+		discoverers.append(ConcurrentWebStoreDiscoverer(d,
+									 url=config['crawl_point'],
+									 db=app_r,
+									 workers=stream_config.get('workers', args.workers),
+									 rate_limiter=rate_limiter,
+									 session=session,
+									 item_fields=config.get('search_item_fields'),
+									 metadata_max_age=config.get('metadata_max_age'),
+									 expansion_suffixes=dicts.get(stream.alphabet.name),
+									 max_phrase_length=config.get('max_phrase_length', 6),
+									 known_filter=known_filters[stream.alphabet],
+									 phrase_sleep=sleep_time,
+									 alphabet=stream,
+									 frontier_shards=shards_from_config(config)))
+
 	# Crawler
-	c = WebStoreDiscoverer(d, url=config['crawl_point'], db=app_r)
+	c = MultiStreamDiscoverer(discoverers)
 
 	# Crawl forever
-	while True:
-		c.run()
-		if sleep_time:
-			logger.info('Sleeping for: %s seconds' % sleep_time)
-			time.sleep(sleep_time)
\ No newline at end of file
+	c.run_forever()
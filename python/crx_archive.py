@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os
+import argparse, json, logging
+
+from dao.crxarchive import CrxArchive
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(description='packs downloaded CRX files into a compressed segment archive')
+parser.add_argument('config', help='path to configuration file')
+subparsers = parser.add_subparsers(dest='command')
+
+migrate_parser = subparsers.add_parser('migrate', help='archive the loose CRX files in crx_root_dir')
+migrate_parser.add_argument('--min-age', dest='min_age', default=30, type=float, help='only archive files older than this many days, default=30')
+migrate_parser.add_argument('--delete', default=False, action='store_true', help='if provided, deletes loose files once they are archived')
+
+get_parser = subparsers.add_parser('get', help='write an archived CRX back out')
+get_parser.add_argument('app_id', help='app id to get')
+get_parser.add_argument('--version', default=None, help='version to get, default=newest')
+get_parser.add_argument('--out', default=None, help='file to write to, default=the original file name')
+
+list_parser = subparsers.add_parser('list', help='list the archived versions of an app')
+list_parser.add_argument('app_id', help='app id to list')
+
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	config = {}
+	with open(args.config, 'r') as f:
+		config = json.loads(f.read())
+
+	archive = CrxArchive(config['crx_archive_dir'],
+						 segment_size=config.get('crx_archive_segment_size', 1024 * 1024 * 1024))
+
+	if args.command == 'migrate':
+		archived = archive.migrate(config['crx_root_dir'], min_age=args.min_age * 86400, delete=args.delete)
+		archive.sync()
+		logger.info('Archived %s CRX files' % archived)
+
+	elif args.command == 'get':
+		entry = archive.find(args.app_id, args.version)
+		if not entry:
+			logger.error('No archived CRX for %s %s' % (args.app_id, args.version or ''))
+			sys.exit(1)
+
+		out = args.out or entry.filename
+		with open(out, 'wb') as f:
+			f.write(archive.read(entry))
+		logger.info('Wrote %s %s to %s' % (entry.app_id, entry.version, out))
+
+	elif args.command == 'list':
+		for entry in archive.versions(args.app_id):
+			print '%s\t%s\t%s bytes' % (entry.version, entry.filename, entry.size)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from basestore import BaseStore
+import redis, json
+import config_utils
+
+from dictsearchstore import AlphabetType
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class SearchItemMetadata(object):
+	"""Compact metadata for one app, harvested from the item array that
+	crawl_point returns for every search result.
+
+	DEFAULT_FIELDS maps each field to its index in the item array. The
+	store does not document this layout, so it can be overridden with
+	the search_item_fields section of the configuration file (compare
+	against a page saved with benchmark.py record).
+	"""
+
+	DEFAULT_FIELDS = {
+		'name': 1,
+		'rating_value': 12,
+		'rating_count': 22,
+		'downloads': 23,
+		'price': 30
+	}
+
+	def __init__(self, app_id, name=None, rating_value=None, rating_count=None,
+				 downloads=None, price=None, harvest_time=None):
+		self.app_id = app_id
+		self.name = name
+		self.rating_value = rating_value
+		self.rating_count = rating_count
+		self.downloads = downloads
+		self.price = price
+		self.harvest_time = harvest_time or config_utils.current_time_millis()
+
+	@staticmethod
+	def to_number(value, cast):
+		"""Convert '1,234+ users' or '$1.99' style strings with cast.
+		Returns None if there is no number in value.
+		"""
+		if value is None or isinstance(value, (int, long, float)):
+			return value
+		digits = ''.join(c for c in unicode(value) if c.isdigit() or c == '.')
+		try:
+			return cast(digits)
+		except ValueError:
+			return None
+
+	@staticmethod
+	def from_search_item(item, fields=None):
+		"""Build a record from one getitemsresponse item array. Fields
+		that are missing or malformed are left as None.
+		"""
+		fields = fields or SearchItemMetadata.DEFAULT_FIELDS
+
+		def get(field):
+			index = fields.get(field)
+			if index is None or index >= len(item):
+				return None
+			return item[index]
+
+		name = get('name')
+		return SearchItemMetadata(
+			app_id=item[0],
+			name=name if isinstance(name, basestring) else None,
+			rating_value=SearchItemMetadata.to_number(get('rating_value'), float),
+			rating_count=SearchItemMetadata.to_number(get('rating_count'), int),
+			downloads=SearchItemMetadata.to_number(get('downloads'), int),
+			price=SearchItemMetadata.to_number(get('price'), float)
+			)
+
+	def is_fresh(self, max_age):
+		"""True if this record was harvested less than max_age ms ago."""
+		return self.harvest_time >= config_utils.current_time_millis() - max_age
+
+	def to_value(self):
+		"""What this record's value looks like."""
+		value = dict(vars(self))
+		value['__type__'] = 'SearchItemMetadata'
+		return json.dumps(value)
+
+	@staticmethod
+	def deserialize(json):
+		if '__type__' in json and json['__type__'] == 'SearchItemMetadata':
+			return SearchItemMetadata(
+				app_id=json['app_id'],
+				name=json['name'],
+				rating_value=json['rating_value'],
+				rating_count=json['rating_count'],
+				downloads=json['downloads'],
+				price=json['price'],
+				harvest_time=json['harvest_time']
+				)
+		raise TypeError('Requested json to deserialized into a SearchItemMetadata did not have the correct __type__: %s' % json)
+
+
+class AppMetadataStore(BaseStore):
+	"""Keeps the most recent SearchItemMetadata for every app in one
+	Redis hash per alphabet, keyed by app_id.
+	"""
+	r = None
+
+	def __init__(self, redis_instance):
+		self.r = redis_instance
+
+	def get(self, app_id, alphabet=AlphabetType.en_US):
+		"""Returns the SearchItemMetadata for app_id, or None."""
+		value = self.r.hget(alphabet.meta_name(), app_id)
+		if value is None:
+			return None
+		return SearchItemMetadata.deserialize(json.loads(value))
+
+	def get_many(self, app_ids, alphabet=AlphabetType.en_US):
+		"""Returns {app_id: SearchItemMetadata} for the app_ids that
+		have a record, in one round trip.
+		"""
+		if not app_ids:
+			return {}
+		records = {}
+		for app_id, value in zip(app_ids, self.r.hmget(alphabet.meta_name(), app_ids)):
+			if value is not None:
+				records[app_id] = SearchItemMetadata.deserialize(json.loads(value))
+		return records
+
+	def put(self, record, alphabet=AlphabetType.en_US, pipe=None):
+		"""Store record, overwriting any older record for its app.
+
+		If pipe is given, the write is only queued on it.
+		"""
+		client = pipe if pipe is not None else self.r
+		return client.hset(alphabet.meta_name(), record.app_id, record.to_value())
+
+	def put_pipelined(self, records, alphabet=AlphabetType.en_US):
+		"""Using pipelining, put all the records into Redis."""
+		with self.r.pipeline() as pipe:
+			for record in records:
+				self.put(record, alphabet, pipe)
+			return pipe.execute()
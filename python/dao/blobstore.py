@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, errno, hashlib, json, threading
+import redis
+
+from dictsearchstore import AlphabetType
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def file_digest(path, chunk_size=64 * 1024):
+	"""Hex SHA-1 of the contents of the file at path."""
+	digest = hashlib.sha1()
+	with open(path, 'rb') as fp:
+		for chunk in iter(lambda: fp.read(chunk_size), ''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+class BlobStore(object):
+	"""Content addressed store for the files of extracted apps.
+
+	Every unique file is kept once under blob_dir, named by its SHA-1,
+	and the copies in the per-app trees are replaced by hardlinks to
+	it. blob_dir has to be on the same filesystem as the app trees;
+	where a hardlink can't be made, the copy is left alone and only
+	indexed.
+
+	Redis keeps a corpus wide index of which apps contain each blob,
+	and of which blob each file of an app is, so that analyzers can
+	work per unique file instead of per copy (see get_result and
+	put_result).
+
+	Files in the app trees are shared, so they must never be modified
+	in place. Replace them by unlinking first, like sync_tree does.
+	"""
+
+	def __init__(self, blob_dir, redis_instance, alphabet=AlphabetType.en_US):
+		self.blob_dir = blob_dir
+		self.r = redis_instance
+		self.alphabet = alphabet
+
+	def blob_path(self, digest):
+		return os.path.join(self.blob_dir, digest[:2], digest[2:])
+
+	def app_blobs_name(self, app_id):
+		return ':'.join((self.alphabet.app_blobs_prefix(), app_id))
+
+	def blob_apps_name(self, digest):
+		return ':'.join((self.alphabet.blob_apps_prefix(), digest))
+
+	def is_linked(self, path, digest):
+		"""True if path is already a hardlink of blob digest."""
+		try:
+			return os.path.samefile(path, self.blob_path(digest))
+		except OSError:
+			return False
+
+	def link(self, path, digest=None):
+		"""Store the file at path as a blob, and make path a hardlink
+		to it. Returns the digest of the blob.
+		"""
+		digest = digest or file_digest(path)
+		blob_path = self.blob_path(digest)
+
+		if not os.path.isdir(os.path.dirname(blob_path)):
+			try:
+				os.makedirs(os.path.dirname(blob_path))
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise
+
+		try:
+			try:
+				os.link(path, blob_path)
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise
+				if os.path.samefile(path, blob_path):
+					return digest
+
+				# Known blob: link it under a temporary name, then rename
+				# that over path, so path is never missing
+				temp_path = '%s.%s.%s.blob' % (path, os.getpid(), threading.current_thread().ident)
+				os.link(blob_path, temp_path)
+				os.rename(temp_path, path)
+		except OSError, e:
+			if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+				raise
+			logger.warn('Could not hardlink %s to blob %s: %s' % (path, digest, e))
+		return digest
+
+	def digests(self, app_id):
+		"""Returns {relative path: digest} for every file of app_id as
+		of its last index_app.
+		"""
+		return self.r.hgetall(self.app_blobs_name(app_id))
+
+	def index_app(self, app_id, app_dir, keep=('.git',)):
+		"""Move every file of app_dir into the store and record which
+		blobs app_id now contains. Top level entries named in keep are
+		skipped.
+
+		Files that are still linked to the blob they were indexed as
+		last time are not hashed again.
+
+		Returns the number of files that were hashed.
+		"""
+		previous = self.digests(app_id)
+		current = {}
+		hashed = 0
+
+		for root, dirs, files in os.walk(app_dir):
+			if root == app_dir:
+				dirs[:] = [ name for name in dirs if name not in keep ]
+				files = [ name for name in files if name not in keep ]
+
+			for name in files:
+				path = os.path.join(root, name)
+				if os.path.islink(path) or not os.path.isfile(path):
+					continue
+				relative = os.path.relpath(path, app_dir).replace(os.sep, '/')
+
+				digest = previous.get(relative)
+				if not digest or not self.is_linked(path, digest):
+					digest = self.link(path)
+					hashed += 1
+				current[relative] = digest
+
+		old_blobs = set(previous.values()) - set(current.values())
+		new_blobs = set(current.values()) - set(previous.values())
+
+		with self.r.pipeline() as pipe:
+			pipe.delete(self.app_blobs_name(app_id))
+			if current:
+				pipe.hmset(self.app_blobs_name(app_id), current)
+			for digest in old_blobs:
+				pipe.srem(self.blob_apps_name(digest), app_id)
+			for digest in new_blobs:
+				pipe.sadd(self.blob_apps_name(digest), app_id)
+			pipe.execute()
+
+		logger.info('Indexed %s files of app %s into blob store (%s hashed, %s new blobs)'
+					% (len(current), app_id, hashed, len(new_blobs)))
+		return hashed
+
+	def apps_with(self, digest):
+		"""The set of app_ids that contain blob digest."""
+		return self.r.smembers(self.blob_apps_name(digest))
+
+	def get_result(self, analyzer, digest):
+		"""Returns the cached result of analyzer for blob digest, or
+		None.
+		"""
+		value = self.r.hget(self.alphabet.blob_results_name(analyzer), digest)
+		if value is None:
+			return None
+		return json.loads(value)
+
+	def put_result(self, analyzer, digest, result):
+		"""Cache the JSON serializable result of analyzer for blob
+		digest.
+		"""
+		return self.r.hset(self.alphabet.blob_results_name(analyzer), digest, json.dumps(result))
+
+	def prune(self):
+		"""Delete blobs that no app tree links to anymore.
+
+		Returns the number of blobs deleted.
+		"""
+		pruned = 0
+		for root, dirs, files in os.walk(self.blob_dir):
+			for name in files:
+				path = os.path.join(root, name)
+				if os.stat(path).st_nlink > 1:
+					continue
+				digest = os.path.basename(root) + name
+				if self.r.scard(self.blob_apps_name(digest)):
+					# Indexed without a hardlink, keep it
+					continue
+				os.unlink(path)
+				pruned += 1
+		logger.info('Pruned %s unreferenced blobs' % pruned)
+		return pruned
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib, math, struct, threading, time
+import redis
+import logging
+
+from dictsearchstore import AlphabetType
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+	"""Compact set membership test with no false negatives and a
+	false positive rate of about error_rate while it holds no more
+	than capacity items.
+	"""
+
+	def __init__(self, capacity, error_rate=0.001, salt=''):
+		if capacity < 1:
+			raise ValueError('BloomFilter capacity must be at least 1: %s' % capacity)
+		if not 0 < error_rate < 1:
+			raise ValueError('BloomFilter error_rate must be between 0 and 1: %s' % error_rate)
+
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.salt = salt
+		self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+		self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * math.log(2))))
+		self.bits = bytearray((self.num_bits + 7) // 8)
+		self.count = 0
+
+	def __positions(self, item):
+		# Double hashing: bit i is h1 + i * h2, from one md5 digest
+		h1, h2 = struct.unpack('<QQ', hashlib.md5(self.salt + item).digest())
+		return [ (h1 + i * h2) % self.num_bits for i in range(self.num_hashes) ]
+
+	def add(self, item):
+		"""Add item. Returns False if it was (probably) already there."""
+		new = False
+		for position in self.__positions(item):
+			byte, bit = divmod(position, 8)
+			if not self.bits[byte] & (1 << bit):
+				self.bits[byte] |= 1 << bit
+				new = True
+		if new:
+			self.count += 1
+		return new
+
+	def __contains__(self, item):
+		for position in self.__positions(item):
+			byte, bit = divmod(position, 8)
+			if not self.bits[byte] & (1 << bit):
+				return False
+		return True
+
+	def __len__(self):
+		return self.count
+
+
+class KnownAppIdFilter(object):
+	"""In-process filter of the app ids already in an alphabet's app
+	hash, so that crawlers only send probably-new app ids to Redis.
+
+	The filter is loaded from the app hash, and then updated as app
+	ids are recorded. It is rebuilt from the app hash every
+	resync_interval seconds, or early once it holds more than its
+	capacity. Every rebuild uses a new salt, so an app id that was a
+	false positive gets another chance after the next resync.
+
+	Safe to share between threads.
+	"""
+
+	def __init__(self, db, alphabet=AlphabetType.en_US, capacity=1000000, error_rate=0.001, resync_interval=3600):
+		self.db = db
+		self.alphabet = alphabet
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.resync_interval = resync_interval
+		self.bloom = None
+		self.loaded = 0
+		self.generation = 0
+		self.lock = threading.Lock()
+		self.load_lock = threading.Lock()
+
+	def load(self, force=True):
+		"""Rebuild the filter from the app hash. Without force, only
+		if it is missing, due for a resync or over capacity.
+		"""
+		with self.load_lock:
+			if not force and not self.needs_load():
+				return
+
+			size = self.db.hlen(self.alphabet.name)
+			self.generation += 1
+			bloom = BloomFilter(max(self.capacity, size * 2), self.error_rate, salt='%s:' % self.generation)
+
+			for app_id, value in self.db.hscan_iter(self.alphabet.name, count=1000):
+				bloom.add(app_id)
+
+			with self.lock:
+				self.bloom = bloom
+				self.loaded = time.time()
+			logger.info('Loaded %s app ids into known app id filter for %s' % (len(bloom), self.alphabet.name))
+
+	def needs_load(self):
+		# An empty filter is falsy, so test for None
+		return (self.bloom is None
+				or time.time() - self.loaded >= self.resync_interval
+				or len(self.bloom) > self.bloom.capacity)
+
+	def filter_new(self, app_ids):
+		"""Returns the app_ids that are probably not in the app hash."""
+		if self.needs_load():
+			self.load(force=False)
+		with self.lock:
+			return [ app_id for app_id in app_ids if app_id not in self.bloom ]
+
+	def add(self, app_ids):
+		"""Remember app_ids as recorded in the app hash."""
+		with self.lock:
+			for app_id in app_ids:
+				self.bloom.add(app_id)
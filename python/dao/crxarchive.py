@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, re, mmap, struct, zlib, threading, fcntl, time
+from collections import namedtuple
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Every record in a segment starts with this header, so segments can be
+# read back without the index:
+# magic, compression method, name length, stored length, size, crc32
+RECORD_HEADER = struct.Struct('<4sBHIII')
+RECORD_MAGIC = 'CRXA'
+
+METHOD_STORED = 0
+METHOD_ZLIB = 1
+
+CrxArchiveEntry = namedtuple('CrxArchiveEntry',
+							 ['app_id', 'version', 'filename', 'segment', 'offset', 'length', 'size', 'method', 'crc'])
+
+
+def crx_version_from_filename(filename):
+	"""The app version in a download name like extension_1_2_3.crx,
+	or the file name itself if it has none.
+	"""
+	match = re.search(r'(\d+(?:_\d+)*)\.crx$', filename)
+	if not match:
+		return filename
+	return match.group(1).replace('_', '.')
+
+
+class CrxArchive(object):
+	"""Append-only archive of CRX files, packed into compressed segment
+	files of up to segment_size bytes each.
+
+	Every archived CRX is one record in a segment. The index file has
+	one tab separated line per record with its segment, offset and
+	length, so getting a CRX back is one lookup in the in-memory index
+	and one read of a memory-mapped segment.
+
+	CRXs are zip files whose contents are mostly deflated already, so
+	a record is only stored compressed if that makes it smaller.
+
+	Safe to share between threads. Other processes may read the same
+	archive, and see records added after it was opened on refresh(),
+	but only one process should add to it at a time.
+	"""
+
+	INDEX_NAME = 'index.tsv'
+	SEGMENT_NAME = 'segment-%06d.seg'
+
+	def __init__(self, archive_dir, segment_size=1024 * 1024 * 1024, level=6):
+		self.archive_dir = archive_dir
+		self.segment_size = segment_size
+		self.level = level
+		self.entries = {}
+		self.index_position = 0
+		self.segment = 0
+		self.maps = {}
+		self.unsynced = set()
+		self.lock = threading.RLock()
+
+		if not os.path.exists(archive_dir):
+			os.makedirs(archive_dir)
+		self.index_path = os.path.join(archive_dir, self.INDEX_NAME)
+		self.refresh()
+
+	def segment_path(self, segment):
+		return os.path.join(self.archive_dir, self.SEGMENT_NAME % segment)
+
+	def refresh(self):
+		"""Load index lines added since the last refresh."""
+		with self.lock:
+			if not os.path.exists(self.index_path):
+				return
+			with open(self.index_path, 'rb') as fp:
+				fp.seek(self.index_position)
+				for line in fp:
+					if not line.endswith('\n'):
+						# Partly written by another process, read it next time
+						break
+					self.index_position += len(line)
+					fields = line.rstrip('\n').split('\t')
+					entry = CrxArchiveEntry(fields[0], fields[1], fields[2], *[ int(x) for x in fields[3:] ])
+					self.entries.setdefault(entry.app_id, []).append(entry)
+					self.segment = max(self.segment, entry.segment)
+
+	def versions(self, app_id):
+		"""Archived entries of app_id, oldest first."""
+		with self.lock:
+			return list(self.entries.get(app_id, []))
+
+	def find(self, app_id, version=None):
+		"""The entry of app_id at version, or its newest entry if
+		version is None. Returns None if there is no such entry.
+		"""
+		with self.lock:
+			for entry in reversed(self.entries.get(app_id, [])):
+				if version is None or entry.version == version:
+					return entry
+		return None
+
+	def put(self, app_id, version, filename, data):
+		"""Append a CRX to the archive. Returns its CrxArchiveEntry."""
+		compressed = zlib.compress(data, self.level)
+		if len(compressed) < len(data):
+			method, stored = METHOD_ZLIB, compressed
+		else:
+			method, stored = METHOD_STORED, data
+		crc = zlib.crc32(data) & 0xffffffff
+		name = '/'.join((app_id, version, filename)).encode('utf-8')
+
+		with self.lock:
+			path = self.segment_path(self.segment)
+			if os.path.exists(path) and os.path.getsize(path) + len(stored) > self.segment_size:
+				self.segment += 1
+				path = self.segment_path(self.segment)
+
+			with open(path, 'ab') as fp:
+				fp.seek(0, os.SEEK_END)
+				fp.write(RECORD_HEADER.pack(RECORD_MAGIC, method, len(name), len(stored), len(data), crc))
+				fp.write(name)
+				offset = fp.tell()
+				fp.write(stored)
+
+			self.unsynced.add(self.segment)
+			entry = CrxArchiveEntry(app_id, version, filename, self.segment, offset, len(stored), len(data), method, crc)
+			with open(self.index_path, 'ab') as fp:
+				fcntl.flock(fp, fcntl.LOCK_EX)
+				try:
+					fp.write('\t'.join(str(x) for x in entry) + '\n')
+				finally:
+					fcntl.flock(fp, fcntl.LOCK_UN)
+
+			self.index_position = os.path.getsize(self.index_path)
+			self.entries.setdefault(app_id, []).append(entry)
+			return entry
+
+	def put_file(self, app_id, path, version=None):
+		"""Append the CRX file at path, taking its version from its name
+		unless version is given. Returns its CrxArchiveEntry.
+		"""
+		filename = os.path.basename(path)
+		with open(path, 'rb') as fp:
+			return self.put(app_id, version or crx_version_from_filename(filename), filename, fp.read())
+
+	def sync(self, segments=()):
+		"""Flush every segment written to since the last sync, and the
+		given segments, to disk. Then the index, and the directory so
+		that new segment files are in it.
+		"""
+		with self.lock:
+			segments = self.unsynced | set(segments)
+			paths = [ self.segment_path(segment) for segment in sorted(segments) ] + [ self.index_path ]
+			for path in paths:
+				if os.path.exists(path):
+					with open(path, 'ab') as fp:
+						os.fsync(fp.fileno())
+
+			fd = os.open(self.archive_dir, os.O_RDONLY)
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+			self.unsynced.clear()
+
+	def __map(self, segment, end):
+		# Segments only grow, remap if the record is past the mapping
+		segment_map = self.maps.get(segment)
+		if segment_map is None or len(segment_map) < end:
+			if segment_map is not None:
+				segment_map.close()
+			with open(self.segment_path(segment), 'rb') as fp:
+				segment_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+			self.maps[segment] = segment_map
+		return segment_map
+
+	def read(self, entry):
+		"""The CRX data of entry."""
+		with self.lock:
+			segment_map = self.__map(entry.segment, entry.offset + entry.length)
+			stored = segment_map[entry.offset:entry.offset + entry.length]
+
+		data = zlib.decompress(stored) if entry.method == METHOD_ZLIB else stored
+		if zlib.crc32(data) & 0xffffffff != entry.crc:
+			raise IOError('Archived CRX of %s %s is corrupt' % (entry.app_id, entry.version))
+		return data
+
+	def get(self, app_id, version=None):
+		"""The CRX data of app_id at version (default newest), or None
+		if it is not archived.
+		"""
+		entry = self.find(app_id, version)
+		if not entry:
+			self.refresh()
+			entry = self.find(app_id, version)
+		if not entry:
+			return None
+		return self.read(entry)
+
+	def close(self):
+		with self.lock:
+			for segment_map in self.maps.values():
+				segment_map.close()
+			self.maps = {}
+
+	def matches(self, entry, path):
+		"""True if the file at path holds the same CRX as entry."""
+		if os.path.getsize(path) != entry.size:
+			return False
+		crc = 0
+		with open(path, 'rb') as fp:
+			for chunk in iter(lambda: fp.read(64 * 1024), ''):
+				crc = zlib.crc32(chunk, crc)
+		return crc & 0xffffffff == entry.crc
+
+	def migrate(self, crx_dir, min_age=0, delete=False):
+		"""Archive the loose CRX files in crx_dir/<app_id>/<filename>
+		that are at least min_age seconds old. With delete, each loose
+		file is removed once it is safely in the archive.
+
+		A file whose version is archived already, but with different
+		contents, e.g. a re-download of the same version, is archived
+		again as the newest entry of that version.
+
+		Returns the number of files archived.
+		"""
+		archived = 0
+		archived_paths = []
+		segments = set()
+		now = time.time()
+
+		for app_id in sorted(os.listdir(crx_dir)):
+			app_dir = os.path.join(crx_dir, app_id)
+			if not os.path.isdir(app_dir):
+				continue
+
+			for filename in sorted(os.listdir(app_dir)):
+				path = os.path.join(app_dir, filename)
+				if not os.path.isfile(path) or now - os.path.getmtime(path) < min_age:
+					continue
+
+				version = crx_version_from_filename(filename)
+				entry = self.find(app_id, version)
+				if not entry or not self.matches(entry, path):
+					entry = self.put_file(app_id, path, version)
+					archived += 1
+					logger.info('Archived %s %s' % (app_id, version))
+				archived_paths.append(path)
+				segments.add(entry.segment)
+
+		if delete:
+			# Including segments that earlier runs wrote, before anything is deleted
+			self.sync(segments)
+			for path in archived_paths:
+				os.unlink(path)
+			logger.info('Deleted %s loose CRX files' % len(archived_paths))
+		return archived
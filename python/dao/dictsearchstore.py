@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from basestore import BaseStore
-import redis, json
+import redis, json, random, uuid, collections
 import config_utils
 
 from enum import Enum, unique
@@ -13,6 +13,134 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# Move phrases from the tier queues to the in-flight hash, each with
+# a deadline after which the reaper may hand it to someone else, and an
+# owner token that only this claim knows. Up to the wanted count is
+# taken from each tier, and any shortfall is made up from whichever
+# tiers still have phrases, hottest first. Returns value, owner pairs.
+#
+# KEYS[1]  -- in-flight hash, phrase to deadline, tier, value and owner
+# KEYS[2:] -- tier queue lists, hottest first
+# ARGV     -- deadline, owner prefix, then the wanted count for each tier
+CLAIM_SCRIPT = """
+local claimed = {}
+local function pop(tier, count)
+	local popped = 0
+	while popped < count do
+		local value = redis.call('RPOP', KEYS[tier + 1])
+		if not value then
+			break
+		end
+		local phrase = cjson.decode(value)['phrase']
+		local owner = ARGV[2] .. ':' .. (#claimed / 2)
+		redis.call('HSET', KEYS[1], phrase, cjson.encode({deadline=tonumber(ARGV[1]), tier=tier, value=value, owner=owner}))
+		claimed[#claimed + 1] = value
+		claimed[#claimed + 1] = owner
+		popped = popped + 1
+	end
+	return popped
+end
+
+local shortfall = 0
+for tier = 1, #KEYS - 1 do
+	local wanted = tonumber(ARGV[tier + 2])
+	shortfall = shortfall + wanted - pop(tier, wanted)
+end
+for tier = 1, #KEYS - 1 do
+	if shortfall <= 0 then
+		break
+	end
+	shortfall = shortfall - pop(tier, shortfall)
+end
+return claimed
+"""
+
+# Take phrases out of the in-flight hash and put them back on their
+# tier queue. Phrases that were reaped, and maybe claimed again by
+# someone else since, are left alone, so they are not queued twice.
+# Claims from before owner tokens match the empty owner.
+#
+# KEYS[1]  -- in-flight hash
+# KEYS[2:] -- tier queue lists, hottest first
+# ARGV     -- phrase, value, tier, owner, phrase, value, tier, owner, ...
+RELEASE_SCRIPT = """
+local released = 0
+for i = 1, #ARGV, 4 do
+	local claim = redis.call('HGET', KEYS[1], ARGV[i])
+	if claim and (cjson.decode(claim)['owner'] or '') == ARGV[i + 3] then
+		redis.call('HDEL', KEYS[1], ARGV[i])
+		redis.call('LPUSH', KEYS[tonumber(ARGV[i + 2]) + 1], ARGV[i + 1])
+		released = released + 1
+	end
+end
+return released
+"""
+
+# Replace the value of a claimed phrase and push its deadline back.
+# Returns 0 if the phrase is no longer claimed by owner.
+#
+# KEYS[1] -- in-flight hash
+# ARGV    -- phrase, value, deadline, owner
+CHECKPOINT_SCRIPT = """
+local claim = redis.call('HGET', KEYS[1], ARGV[1])
+if not claim then
+	return 0
+end
+claim = cjson.decode(claim)
+if (claim['owner'] or '') ~= ARGV[4] then
+	return 0
+end
+claim['value'] = ARGV[2]
+claim['deadline'] = tonumber(ARGV[3])
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(claim))
+return 1
+"""
+
+# Requeue phrases whose deadline has passed, at the front of the tier
+# they came from so they are picked up next. Each claim is checked and
+# removed in this one script, so a claim that an owner renewed or that
+# someone else made in the meantime is never requeued. Also drains the
+# processing list that older versions of DictionarySearchStore used.
+#
+# KEYS[1]  -- in-flight hash
+# KEYS[2]  -- legacy processing list
+# KEYS[3:] -- tier queue lists, hottest first
+# ARGV     -- now
+REAP_SCRIPT = """
+local reaped = 0
+local inflight = redis.call('HGETALL', KEYS[1])
+for i = 1, #inflight, 2 do
+	local claim = cjson.decode(inflight[i + 1])
+	if claim['deadline'] < tonumber(ARGV[1]) then
+		redis.call('HDEL', KEYS[1], inflight[i])
+		redis.call('RPUSH', KEYS[(claim['tier'] or 1) + 2], claim['value'])
+		reaped = reaped + 1
+	end
+end
+while redis.call('RPOPLPUSH', KEYS[2], KEYS[3]) do
+	reaped = reaped + 1
+end
+return reaped
+"""
+
+
+# Queue the phrases that are new to the set of known phrases.
+#
+# KEYS[1] -- set of every phrase ever queued
+# KEYS[2] -- queue list to add new phrases to
+# ARGV    -- phrase, value, phrase, value, ...
+EXPAND_SCRIPT = """
+local added = 0
+for i = 1, #ARGV, 2 do
+	if redis.call('SADD', KEYS[1], ARGV[i]) == 1 then
+		redis.call('RPUSH', KEYS[2], ARGV[i + 1])
+		added = added + 1
+	end
+end
+return added
+"""
+
+
 @unique
 class AlphabetType(Enum):
 	en_US = 1
@@ -22,27 +150,164 @@ class AlphabetType(Enum):
 		"""The name to use for a separate processing list in Redis."""
 		return '_'.join((self.name, 'processing'))
 
-	def lock_prefix(self):
-		return ':'.join((self.name, 'lock'))
+	def lock_prefix(self, shard=None):
+		"""Prefix of app_id lock names. Locks of a frontier shard share
+		its hash tag, so they live on the same Redis Cluster slot.
+		"""
+		if shard is None:
+			return ':'.join((self.name, 'lock'))
+		return ':'.join((self.name, 'lock', '{%s}' % shard))
+
+	def meta_name(self):
+		"""The name of the hash of harvested app metadata in Redis."""
+		return '_'.join((self.name, 'meta'))
+
+	def frontier_name(self, shard=None):
+		"""The name of the sorted set of app_ids by when they are next
+		due to be fetched in Redis, or of one shard of it.
+		"""
+		if shard is None:
+			return '_'.join((self.name, 'frontier'))
+		return ':'.join(('_'.join((self.name, 'frontier')), '{%s}' % shard))
+
+	def nodes_name(self):
+		"""The name of the sorted set of live crawler nodes by last
+		heartbeat in Redis.
+		"""
+		return '_'.join((self.name, 'nodes'))
+
+	def versions_name(self):
+		"""The name of the hash of last downloaded app versions in Redis."""
+		return '_'.join((self.name, 'versions'))
+
+	def revisits_name(self):
+		"""The name of the hash of fetch observations by app_id in Redis."""
+		return '_'.join((self.name, 'revisits'))
+
+	def blob_apps_prefix(self):
+		"""Prefix of the sets of app_ids that contain a blob in Redis."""
+		return ':'.join((self.name, 'blob_apps'))
+
+	def app_blobs_prefix(self):
+		"""Prefix of the hashes of file path to blob of an app in Redis."""
+		return ':'.join((self.name, 'app_blobs'))
+
+	def blob_results_name(self, analyzer):
+		"""The name of the hash of cached analyzer results by blob in Redis."""
+		return ':'.join((self.name, 'blob_results', analyzer))
 
 	def hyphenated(self):
 		return self.name.replace('_', '-')
 
+class CrawlStream(object):
+	"""One independent crawl of the web store: the phrases of an
+	alphabet searched in one category with one sort order.
+
+	Every stream has its own phrase queues in Redis. The default stream
+	of an alphabet (category apps, sort order 0) uses the alphabet's
+	own key names, so it is the same crawl that a bare AlphabetType
+	refers to.
+	"""
+	DEFAULT_CATEGORY = 'apps'
+	DEFAULT_SORT_BY = '0'
+
+	def __init__(self, alphabet=AlphabetType.en_US, category=DEFAULT_CATEGORY, sort_by=DEFAULT_SORT_BY):
+		if not alphabet in list(AlphabetType):
+			raise TypeError('Tried to initialize CrawlStream with invalid AlphabetType: %s' % alphabet)
+
+		self.alphabet = alphabet
+		self.category = category
+		self.sort_by = unicode(sort_by)
+
+	@staticmethod
+	def from_config(stream_config):
+		"""Build a CrawlStream from one entry of the crawl_streams
+		section of the configuration file.
+		"""
+		return CrawlStream(AlphabetType[stream_config.get('alphabet', 'en_US')],
+						   stream_config.get('category', CrawlStream.DEFAULT_CATEGORY),
+						   stream_config.get('sort_by', CrawlStream.DEFAULT_SORT_BY))
+
+	@staticmethod
+	def of(alphabet_or_stream):
+		"""The CrawlStream for an AlphabetType (its default stream) or
+		CrawlStream.
+		"""
+		if isinstance(alphabet_or_stream, CrawlStream):
+			return alphabet_or_stream
+		return CrawlStream(alphabet_or_stream)
+
+	def is_default(self):
+		return self.category == self.DEFAULT_CATEGORY and self.sort_by == self.DEFAULT_SORT_BY
+
+	@property
+	def name(self):
+		if self.is_default():
+			return self.alphabet.name
+		return ':'.join((self.alphabet.name, self.category, self.sort_by))
+
+	def processing_name(self):
+		"""The name to use for a separate processing list in Redis."""
+		return '_'.join((self.name, 'processing'))
+
+	def inflight_name(self):
+		"""The name of the hash of claimed phrases in Redis."""
+		return '_'.join((self.name, 'inflight'))
+
+	def phrases_name(self):
+		"""The name of the set of every phrase ever queued in Redis."""
+		return '_'.join((self.name, 'phrases'))
+
+	def tier_name(self, tier):
+		"""The name of the phrase list for a PhraseScheduler tier in
+		Redis. The hottest tier is the original list.
+		"""
+		if not tier:
+			return self.name
+		return ':'.join((self.name, 'tier%s' % tier))
+
+	def __eq__(self, other):
+		return isinstance(other, CrawlStream) and self.name == other.name
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __hash__(self):
+		return hash(self.name)
+
+	def __str__(self):
+		return self.name
+
+
 class DictionaryAttackKeyValue:
 	"""Represent an alphabet, a phrase (or letter), and a timestamp for
-	when this key-value was last collected/fetcher.
+	when this key-value was last collected/fetcher. The category and
+	sort order pick the CrawlStream the phrase belongs to.
 	"""
 	alphabet = None
 	phrase = ''
 	last_retrieved = None
+	yield_score = None
+	crawls = 0
+	token = ''
+	category = CrawlStream.DEFAULT_CATEGORY
+	sort_by = CrawlStream.DEFAULT_SORT_BY
+	claim = None
 
-	def __init__(self, phrase='', last_retrieved=None, alphabet=AlphabetType.en_US):
+	def __init__(self, phrase='', last_retrieved=None, alphabet=AlphabetType.en_US, yield_score=None, crawls=0, token='',
+				 category=CrawlStream.DEFAULT_CATEGORY, sort_by=CrawlStream.DEFAULT_SORT_BY, claim=None):
 		"""Initialize this key-value.
 
 		Keyword arguments:
 		phrase -- The phrase or letter part of the overall dictionary attack. (default '')
 		last_retrieved -- A timestamp representing when this key-value was last collected. (default None)
 		alphabet -- An AlphabetType Enum that indicates what language this phrase is from.
+		yield_score -- Moving average of previously unseen app ids found per crawl. (default None)
+		crawls -- How many times this phrase has been crawled to the end. (default 0)
+		token -- Pagination token of the next page to crawl, '' to start from the first page. (default '')
+		category -- Web store category to search in. (default 'apps')
+		sort_by -- Web store sort order of the results. (default '0')
+		claim -- Owner token of the claim this key-value was taken from the queue with, never stored. (default None)
 		"""
 		if not alphabet in list(AlphabetType):
 			raise TypeError('Tried to initialize DictionaryAttackKey with invalid AlphabetType: %s' % alphabet)
@@ -50,6 +315,26 @@ class DictionaryAttackKeyValue:
 		self.alphabet = alphabet
 		self.phrase = phrase
 		self.last_retrieved = last_retrieved
+		self.yield_score = yield_score
+		self.crawls = crawls
+		self.token = token
+		self.category = category
+		self.sort_by = unicode(sort_by)
+		self.claim = claim
+
+	def stream(self):
+		"""The CrawlStream this key-value is queued in."""
+		return CrawlStream(self.alphabet, self.category, self.sort_by)
+
+	def record_yield(self, new_app_ids, weight=0.5):
+		"""Fold the number of new app ids found by a finished crawl
+		into yield_score.
+		"""
+		if self.yield_score is None:
+			self.yield_score = float(new_app_ids)
+		else:
+			self.yield_score = weight * new_app_ids + (1 - weight) * self.yield_score
+		self.crawls += 1
 
 	def to_value(self):
 		"""What this key-value's value looks like."""
@@ -57,7 +342,12 @@ class DictionaryAttackKeyValue:
 			'__type__': 'DictionaryAttackKeyValue',
 			'alphabet': self.alphabet.name,
 			'phrase': self.phrase,
-			'last_retrieved': self.last_retrieved
+			'last_retrieved': self.last_retrieved,
+			'yield_score': self.yield_score,
+			'crawls': self.crawls,
+			'token': self.token,
+			'category': self.category,
+			'sort_by': self.sort_by
 			})
 
 	@staticmethod
@@ -66,52 +356,225 @@ class DictionaryAttackKeyValue:
 			return DictionaryAttackKeyValue(
 				phrase=json['phrase'],
 				alphabet=AlphabetType[json['alphabet']],
-				last_retrieved=json['last_retrieved']
+				last_retrieved=json['last_retrieved'],
+				yield_score=json.get('yield_score'),
+				crawls=json.get('crawls', 0),
+				token=json.get('token', ''),
+				category=json.get('category', CrawlStream.DEFAULT_CATEGORY),
+				sort_by=json.get('sort_by', CrawlStream.DEFAULT_SORT_BY),
+				claim=json.get('claim')
 				)
 		raise TypeError('Requested json to deserialized into a DictionaryAttackKeyValue did not have the correct __type__: %s' % json)
 
 
+class PhraseScheduler(object):
+	"""Decides how often phrases are crawled based on their yield of
+	previously unseen app ids.
+
+	Phrases live in one queue per tier. Released phrases go to the
+	hot tier if they still find many new app ids (or have never been
+	crawled), to the cold tier if they have stopped finding any, and
+	to the warm tier otherwise. Claims take phrases from the tiers in
+	proportion to weights, so hot phrases come around far more often
+	than saturated ones, while cold phrases are still revisited.
+	"""
+
+	def __init__(self, weights=(8, 3, 1), hot_yield=5.0, cold_yield=0.5):
+		self.weights = weights
+		self.hot_yield = hot_yield
+		self.cold_yield = cold_yield
+
+	def tiers(self):
+		return range(len(self.weights))
+
+	def tier_names(self, stream):
+		return [ stream.tier_name(tier) for tier in self.tiers() ]
+
+	def tier_for(self, key_value):
+		"""The tier a released key-value belongs in."""
+		if key_value.yield_score is None or key_value.yield_score >= self.hot_yield:
+			return 0
+		if key_value.yield_score < self.cold_yield:
+			return len(self.weights) - 1
+		return 1
+
+	def claim_plan(self, count):
+		"""Returns how many of count claims to take from each tier."""
+		plan = [0] * len(self.weights)
+		for i in range(count):
+			plan[self.pick()] += 1
+		return plan
+
+	def pick(self):
+		point = random.uniform(0, sum(self.weights))
+		for tier, weight in enumerate(self.weights):
+			point -= weight
+			if point <= 0:
+				return tier
+		return len(self.weights) - 1
+
+
 class DictionarySearchStore(BaseStore):
+	"""Reliable queue of DictionaryAttackKeyValues, one set of tier
+	lists per CrawlStream, scheduled by a PhraseScheduler.
+
+	Methods that take an alphabet accept either an AlphabetType, which
+	means its default stream, or a CrawlStream.
+
+	Claimed phrases are kept in an in-flight hash keyed by phrase, so
+	claiming and releasing are O(1) per phrase. Every claim has a
+	visibility timeout; if it is not released in time, reap() puts
+	the phrase back on the queue for another crawler.
+
+	Every claim also has an owner token, returned as the 'claim' of
+	each claimed value. Checkpoints and releases only act on the claim
+	they name, so a crawler whose claim was reaped and handed to
+	someone else can no longer overwrite or requeue it.
+	"""
 	r = None
 
-	def __init__(self, redis_instance):
+	def __init__(self, redis_instance, visibility_timeout=600, scheduler=None):
 		self.r = redis_instance
+		self.visibility_timeout = visibility_timeout
+		self.scheduler = scheduler or PhraseScheduler()
+		self.claim_script = self.r.register_script(CLAIM_SCRIPT)
+		self.release_script = self.r.register_script(RELEASE_SCRIPT)
+		self.reap_script = self.r.register_script(REAP_SCRIPT)
+		self.expand_script = self.r.register_script(EXPAND_SCRIPT)
+		self.checkpoint_script = self.r.register_script(CHECKPOINT_SCRIPT)
 
-	def get_next(self, alphabet=AlphabetType.en_US):
+	def get_next(self, alphabet=AlphabetType.en_US, visibility_timeout=None):
 		"""Pop the next value from the list of values indicated by the
 		alphabet parameter.
 
 		Keyword arguments:
-		alphabet -- AlphabetType Enum representing the language that you want to get the next value for.
+		alphabet -- AlphabetType Enum representing the language that you want to get the next value for, or a CrawlStream.
+		visibility_timeout -- Seconds before the reaper may requeue the value. (default store's visibility_timeout)
+
+		Returns None if there is nothing left in the list.
 		"""
-		return json.loads(self.r.rpoplpush(alphabet.name, alphabet.processing_name()))
+		values = self.get_next_batch(alphabet, 1, visibility_timeout)
+		if not values:
+			return None
+		return values[0]
+
+	def get_next_batch(self, alphabet=AlphabetType.en_US, count=1, visibility_timeout=None):
+		"""Pop up to count values in one round trip. Returns a list,
+		which is empty if there is nothing left in the list.
+		"""
+		if visibility_timeout is None:
+			visibility_timeout = self.visibility_timeout
+		deadline = config_utils.current_time_millis() + int(visibility_timeout * 1000)
+
+		stream = CrawlStream.of(alphabet)
+		claimed = self.claim_script(
+			keys=[stream.inflight_name()] + self.scheduler.tier_names(stream),
+			args=[deadline, uuid.uuid4().hex] + self.scheduler.claim_plan(count))
+
+		values = []
+		for i in range(0, len(claimed), 2):
+			value = json.loads(claimed[i])
+			value['claim'] = claimed[i + 1]
+			values.append(value)
+		return values
 
 	def release(self, key_value):
 		"""Atomically release the key-value to return it to the queue."""
-		alphabet = key_value.alphabet
-		pipeline = self.r.pipeline()
-		pipeline.lrem(alphabet.processing_name(), -1, key_value.to_value())
-		key_value.last_retrieved = config_utils.current_time_millis()
-		pipeline.lpush(alphabet.name, key_value.to_value())
-		return pipeline.execute()
+		return self.release_batch([key_value])
+
+	def release_batch(self, key_values):
+		"""Atomically release key-values, which may be of different
+		streams, to return them to their queues.
+
+		Returns the number of key-values returned.
+		"""
+		by_stream = {}
+		for key_value in key_values:
+			key_value.last_retrieved = config_utils.current_time_millis()
+			tier = self.scheduler.tier_for(key_value)
+			by_stream.setdefault(key_value.stream(), []).extend(
+				(key_value.phrase, key_value.to_value(), tier + 1, key_value.claim or ''))
+			logger.info('Phrase %s yields %s new app ids per crawl, tier %s' %
+						(key_value.phrase, key_value.yield_score, tier))
+
+		released = 0
+		for stream, args in by_stream.items():
+			released += self.release_script(
+				keys=[stream.inflight_name()] + self.scheduler.tier_names(stream),
+				args=args)
+		return released
+
+	def checkpoint(self, key_value, visibility_timeout=None):
+		"""Save the current state of a claimed key-value, such as its
+		pagination token, and extend its visibility timeout.
+
+		If the crawler dies, the reaper requeues the checkpointed
+		value, so the next crawler picks up where this one stopped.
+		Returns False if key_value's claim is gone or was replaced.
+		"""
+		if visibility_timeout is None:
+			visibility_timeout = self.visibility_timeout
+		deadline = config_utils.current_time_millis() + int(visibility_timeout * 1000)
+
+		return bool(self.checkpoint_script(
+			keys=[key_value.stream().inflight_name()],
+			args=[key_value.phrase, key_value.to_value(), deadline, key_value.claim or '']))
+
+	def reap(self, alphabet=AlphabetType.en_US):
+		"""Requeue every claimed value of alphabet whose visibility
+		timeout has passed. Returns the number of values requeued.
+		"""
+		stream = CrawlStream.of(alphabet)
+		reaped = self.reap_script(
+			keys=[stream.inflight_name(), stream.processing_name()] + self.scheduler.tier_names(stream),
+			args=[config_utils.current_time_millis()])
+		if reaped:
+			logger.warn('Requeued %s abandoned phrases for %s' % (reaped, stream.name))
+		return reaped
+
+	def expand(self, key_value, suffixes):
+		"""Queue a child phrase for every suffix appended to
+		key_value's phrase, skipping phrases that were queued before.
+
+		Returns the number of phrases added.
+		"""
+		stream = key_value.stream()
+		args = []
+		for suffix in suffixes:
+			child = DictionaryAttackKeyValue(phrase=key_value.phrase + suffix, alphabet=key_value.alphabet,
+											 category=key_value.category, sort_by=key_value.sort_by)
+			args.extend((child.phrase, child.to_value()))
+
+		added = self.expand_script(
+			keys=[stream.phrases_name(), stream.tier_name(0)],
+			args=args)
+		logger.info('Expanded phrase %s into %s new phrases' % (key_value.phrase, added))
+		return added
 
 	def put(self, key_value):
 		raise NotImplementedError
 
-	def put_pipelined(self, key_values):
-		"""Using pipelining, put all the requested key-values into Redis.
+	def put_pipelined(self, key_values, batch_size=1000):
+		"""Put all the requested key-values into Redis, batch_size per
+		round trip, skipping phrases that were queued before.
 
-		Return value is the result of the pipeline.
+		Returns the number of key-values queued.
 		"""
-		pipe = self.r.pipeline()
-
+		batches = collections.OrderedDict()
 		for key_value in key_values:
-			list_name = key_value.alphabet.name
-			json_value = key_value.to_value()
-			pipe.rpush(list_name, json_value)
-			logger.info('Queued pipelined put: %s, %s' % (list_name, json_value))
+			batches.setdefault(key_value.stream().name, (key_value.stream(), []))[1].append(key_value)
 
-		return pipe.execute()
+		added = 0
+		for stream, stream_key_values in batches.values():
+			for start in range(0, len(stream_key_values), batch_size):
+				args = []
+				for key_value in stream_key_values[start:start + batch_size]:
+					args.extend((key_value.phrase, key_value.to_value()))
+				# The SADD and RPUSH of a phrase go together, so a known
+				# phrase is never queued again
+				added += self.expand_script(keys=[stream.phrases_name(), stream.tier_name(0)], args=args)
+			logger.info('Queued %s phrases into %s' % (len(stream_key_values), stream.name))
+		return added
 
 	def delete_all(self):
 		"""Delete every single thing from Redis."""
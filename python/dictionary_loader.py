@@ -1,4 +1,4 @@
-from dao.dictsearchstore import DictionarySearchStore, DictionaryAttackKeyValue, AlphabetType
+from dao.dictsearchstore import DictionarySearchStore, DictionaryAttackKeyValue, AlphabetType, CrawlStream
 import redis
 import argparse, json, config_utils
 
@@ -22,10 +22,18 @@ if __name__ == '__main__':
 
 	d.delete_all()
 
-	# Load all alphabets' phrases into Redis
-	for alphabet in dicts.keys():
+	# Every crawl stream gets its own copy of its alphabet's phrases.
+	# Without crawl_streams, every alphabet is crawled in its default stream
+	streams = [ CrawlStream.from_config(x) for x in config.get('crawl_streams', []) ]
+	if not streams:
+		streams = [ CrawlStream(AlphabetType[alphabet]) for alphabet in dicts.keys() ]
+
+	# Load all streams' phrases into Redis
+	for stream in streams:
 		key_values = [ DictionaryAttackKeyValue(phrase=x,
-						alphabet=AlphabetType[alphabet]) for x in dicts[alphabet] ]
+						alphabet=stream.alphabet,
+						category=stream.category,
+						sort_by=stream.sort_by) for x in dicts[stream.alphabet.name] ]
 
-		for result in d.put_pipelined(key_values):
-			assert result
\ No newline at end of file
+		added = d.put_pipelined(key_values)
+		print 'Queued %s phrases for %s, %s were already queued' % (added, stream.name, len(key_values) - added)
\ No newline at end of file
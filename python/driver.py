@@ -3,14 +3,22 @@
 
 import redis
 import argparse, json, config_utils
-import time
+import time, threading
 from elasticsearch import Elasticsearch
 
 from dao.dictsearchstore import DictionarySearchStore, DictionaryAttackKeyValue
 from crawler.discoverer import *
 from crawler.fetcher import *
+from crawler.pipeline import FetchPipeline
 from analyzer.single_analyzer import *
 from analyzer.reports.single_reports import *
+from crawler.http_session import session_from_config
+from crawler.httpcache import cache_from_config
+from dao.appmetastore import AppMetadataStore
+from dao.blobstore import BlobStore
+from synchronization.ratelimit import TokenBucket, rate_limiters_from_config
+from synchronization.revisit import revisit_policy_from_config
+from synchronization.sharding import shards_from_config, membership_from_config
 
 
 logging.basicConfig(level=logging.INFO)
@@ -21,10 +29,23 @@ parser = argparse.ArgumentParser(description='driver for crawling')
 parser.add_argument('config', help='path to configuration file')
 parser.add_argument('--sleep', default=1, type=float, help='time to sleep in seconds in between dictionary attack keys, default=1')
 parser.add_argument('--alphabet', default='en_US', help='alphabet to use, default=en_US')
-
-
-if __name__ == '__main__':
-	args = parser.parse_args()
+parser.add_argument('--batch', default=1, type=int, help='number of app ids to lease per round trip, default=1')
+parser.add_argument('--lease-ttl', dest='lease_ttl', default=30, type=float, help='seconds an app id lease lasts without a heartbeat, default=30')
+parser.add_argument('--sync-frontier', dest='sync_frontier', default=False, action='store_true', help='if provided, first adds app ids that predate the fetch frontier to it')
+parser.add_argument('--shard-frontier', dest='shard_frontier', default=False, action='store_true', help='if provided, first moves app ids from the unsharded fetch frontier into its shards')
+parser.add_argument('--pipeline', default=False, action='store_true', help='if provided, fetches, analyzes and stores apps in concurrent stages')
+parser.add_argument('--fetchers', default=4, type=int, help='fetch threads in pipeline mode, default=4')
+parser.add_argument('--analyzers', default=None, type=int, help='analysis processes in pipeline mode, default=number of CPUs')
+parser.add_argument('--rate', default=1/3.0, type=float, help='downloads per second of this process without a shared fetch_point rate limit, default=0.33')
+
+
+def main(args, stop_event=None):
+	"""Fetch, analyze and store apps until stop_event is set. The app
+	being worked on is finished first, and leases on the rest are
+	handed back.
+	"""
+	if stop_event is None:
+		stop_event = threading.Event()
 	sleep_time = args.sleep
 
 	config = {}
@@ -42,25 +63,63 @@ if __name__ == '__main__':
 
 	# Discovering (Crawling) happens separately
 
-	# Instantiate metadata fetcher, which gets passed into fetcher
-	m = MetadataFetcher(base_url=config['detail_page'])
+	# Request budgets shared with every other crawler process, if configured
+	rate_limiters = rate_limiters_from_config(config, app_r)
+
+	# One pooled HTTP session shared by both fetchers
+	session = session_from_config(config, rate_limiters=rate_limiters)
+
+	# Conditional requests for detail pages and crxs, if configured
+	cache = cache_from_config(config)
+
+	alphabet = AlphabetType[args.alphabet]
+
+	# Instantiate metadata fetcher, which gets passed into fetcher.
+	# With metadata_max_age configured, it reuses metadata the discoverer
+	# harvested from search results that are at most that old, instead
+	# of fetching the detail page. Check the search_item_fields layout
+	# against a recorded page before turning this on.
+	meta_store = None
+	if config.get('metadata_max_age'):
+		meta_store = AppMetadataStore(app_r)
+	m = MetadataFetcher(base_url=config['detail_page'],
+						session=session,
+						meta_store=meta_store,
+						max_record_age=config.get('metadata_max_age', 86400000),
+						alphabet=alphabet,
+						cache=cache,
+						rate_limiter=rate_limiters.get('detail_page'))
+
+	# Identical files of different apps are stored once, if configured.
+	# The blob directory must be on the same filesystem as git_root_dir
+	blob_store = None
+	if config.get('blob_root_dir'):
+		blob_store = BlobStore(config['blob_root_dir'], app_r, alphabet=alphabet)
+
+	# Revisit apps by how often they change, if configured
+	revisit_policy = revisit_policy_from_config(config, app_r, alphabet)
 
 	# CRX fetcher, also fetches metadata at the same time
 	f = ChromePackageFetcher(url=config['fetch_point'],
 							 db=app_r,
 							 git_dir=git_root_dir,
 							 crx_dir=crx_root_dir,
-							 metadata_fetcher=m)
+							 metadata_fetcher=m,
+							 session=session,
+							 keep_crx=config.get('keep_crx', True),
+							 spool_max_size=config.get('crx_spool_max_size', 16 * 1024 * 1024),
+							 blob_store=blob_store,
+							 cache=cache,
+							 revisit_policy=revisit_policy)
 
 	# Chained list of analyzers
-	analyzers = [
-		LeastPrivilegeAnalyzer(git_dir=git_root_dir),
-		#MaliciousFlowAnalyzer(git_dir=git_root_dir),
-		JSUnpackAnalyzer(git_dir=git_root_dir),
-		WepawetAnalyzer(git_dir=git_root_dir)
-	]
-
-	alphabet = AlphabetType[args.alphabet]
+	def build_analyzers():
+		return [
+			LeastPrivilegeAnalyzer(git_dir=git_root_dir),
+			#MaliciousFlowAnalyzer(git_dir=git_root_dir),
+			JSUnpackAnalyzer(git_dir=git_root_dir, blob_store=blob_store),
+			WepawetAnalyzer(git_dir=git_root_dir)
+		]
 
 	# Elasticsearch report settings to use in the ReportStore
 	es_conf = ElasticSearchStoreConfiguration(
@@ -72,35 +131,75 @@ if __name__ == '__main__':
 		}
 	)
 
-	lock = ApplicationIdLocker(db=app_r, alphabet=alphabet)
+	# Paces downloads, replaces the fixed sleep after every app
+	fetch_limiter = rate_limiters.get('fetch_point') or TokenBucket(rate=args.rate, capacity=1)
+
+	# With a sharded frontier, this node only claims from the shards it owns
+	membership = membership_from_config(config, app_r, alphabet)
+	if membership:
+		membership.start()
+
+	lock = ApplicationIdLocker(db=app_r, alphabet=alphabet, ttl=args.lease_ttl, revisit_policy=revisit_policy,
+							   shards=shards_from_config(config), membership=membership)
+	if args.shard_frontier:
+		lock.shard_frontier()
+	if args.sync_frontier:
+		lock.sync_frontier()
 	store = ReportStore(console=False, out_dir=reports_root_dir, es_conf=es_conf)
 
-	while True:
+	if args.pipeline:
+		pipeline = FetchPipeline(lock, f, build_analyzers, store,
+								 fetchers=args.fetchers,
+								 analyzers=args.analyzers,
+								 rate_limiter=fetch_limiter)
+		pipeline.run_forever(stop_event)
+		if membership:
+			membership.stop()
+		return
+
+	analyzers = build_analyzers()
+
+	# Keep leases alive while apps are being fetched and analyzed
+	lock.start_heartbeat()
+
+	while not stop_event.is_set():
+		# Lease a batch of app_ids that no one else is working on
+		app_ids = lock.claim(args.batch)
 		try:
-			# Get an app_id, add to en_US_processing_set (with TTL)
-			# if not already in the set, else get another app_id
-			app_id = lock.set_lock_get_id()
-			if app_id:
-				# Fetch app and fetch metadata for the app
-				metadata = f.run(app_id)
-
-				if metadata:
-					reports = { metadata.__type__: metadata }
-					for analyzer in analyzers:
-						report_name = analyzer.__class__.__name__
-						try:
-							reports[report_name] = analyzer.analyze(app_id)
-						except TypeError, e:
-							logger.exception('TypeError during analyzing, possible issue is due to regex parsing failure in the slimit lexer')
-							reports[report_name] = FailureReport(report_type=report_name, message=unicode(e))
-						except UnicodeDecodeError, e:
-							logger.exception('UnicodeDecodeError during analyzing, possibly due to incorrectly encoded JSON')
-							reports[report_name] = FailureReport(report_type=report_name, message=unicode(e))
-
-					store.put(reports, vars(metadata))
-
-			logger.info('done with: %s' % app_id)
-			import time
-			time.sleep(3)
+			for app_id in app_ids:
+				if stop_event.is_set():
+					break
+
+				succeeded = False
+				try:
+					# Fetch app and fetch metadata for the app
+					fetch_limiter.acquire()
+					metadata = f.run(app_id)
+
+					if metadata:
+						reports = { metadata.__type__: metadata }
+						reports.update(run_analyzers(analyzers, app_id))
+						store.put(reports, vars(metadata))
+					succeeded = True
+				finally:
+					f.finish(app_id, succeeded)
+					lock.complete(app_id)
+
+				logger.info('done with: %s' % app_id)
+				if cache:
+					logger.info('HTTP cache: %s' % dict(cache.stats))
 		finally:
-			lock.unlock()
+			# Hand back any leased app_ids we did not get to
+			lock.release(*app_ids)
+
+		if not app_ids:
+			stop_event.wait(3)
+
+	lock.stop_heartbeat()
+	if membership:
+		membership.stop()
+	logger.info('Driver stopped')
+
+
+if __name__ == '__main__':
+	main(parser.parse_args())
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, sys, errno, signal, time, threading
+import argparse, multiprocessing
+import logging
+
+# Import the whole analysis stack once, before forking, so that every
+# worker shares the already imported modules
+import driver
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(description='supervisor that runs and restarts driver workers',
+								 parents=[driver.parser], conflict_handler='resolve')
+parser.add_argument('--workers', default=None, type=int, help='number of driver processes, default=number of CPUs, or 1 with --pipeline')
+parser.add_argument('--drain-timeout', dest='drain_timeout', default=600, type=float, help='seconds to wait for workers to finish their current app on shutdown, default=600')
+
+
+class Supervisor(object):
+	"""Forks workers that each run driver.main, restarts the ones
+	that die, and drains them on SIGTERM or SIGINT.
+
+	Workers are forked from a process that already imported the
+	analysis stack. Each worker opens its own Redis and Elasticsearch
+	connections after the fork.
+
+	A worker that dies soon after it was started is restarted with an
+	exponential backoff, so a broken configuration does not turn into
+	a fork loop.
+	"""
+
+	MIN_UPTIME = 30
+	MAX_BACKOFF = 60
+
+	def __init__(self, args, workers, drain_timeout=600):
+		self.args = args
+		self.workers = workers
+		self.drain_timeout = drain_timeout
+		self.children = {}
+		self.started = {}
+		self.backoff = {}
+		self.stopping = False
+		self.spawning = False
+
+	def run_worker(self, index):
+		"""Runs in the forked worker. Never returns."""
+		stop_event = threading.Event()
+
+		def stop(signum, frame):
+			logger.info('Worker %s draining' % index)
+			stop_event.set()
+
+		signal.signal(signal.SIGTERM, stop)
+		# Restart interrupted system calls, so that a socket read of the
+		# app being finished does not fail with EINTR
+		signal.siginterrupt(signal.SIGTERM, False)
+		# Ctrl-C reaches the whole process group, the supervisor decides
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+		# Caught by the supervisor's handler between the fork and here
+		if self.stopping:
+			stop_event.set()
+
+		code = 0
+		try:
+			driver.main(self.args, stop_event)
+		except Exception:
+			logger.exception('Worker %s crashed' % index)
+			code = 1
+		finally:
+			logging.shutdown()
+			os._exit(code)
+
+	def spawn(self, index):
+		# Python 2 can't block signals, so stop() leaves signalling to
+		# this method while a child is forked but not yet recorded
+		self.spawning = True
+		try:
+			pid = os.fork()
+			if pid == 0:
+				self.run_worker(index)
+
+			self.children[pid] = index
+			self.started[index] = time.time()
+		finally:
+			self.spawning = False
+		logger.info('Started worker %s with pid %s' % (index, pid))
+
+		if self.stopping:
+			self.signal_children()
+
+	def signal_children(self):
+		for pid in list(self.children):
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+
+	def stop(self, signum, frame):
+		if self.stopping:
+			return
+		self.stopping = True
+		logger.info('Draining %s workers' % len(self.children))
+		if not self.spawning:
+			self.signal_children()
+
+	def reap(self):
+		"""Wait for a worker to exit. Returns (pid, status), or None
+		if the wait was interrupted by a signal.
+		"""
+		try:
+			return os.waitpid(-1, 0)
+		except OSError, e:
+			if e.errno in (errno.EINTR, errno.ECHILD):
+				return None
+			raise
+
+	def restart_delay(self, index):
+		"""Seconds to wait before restarting worker index."""
+		if time.time() - self.started[index] >= self.MIN_UPTIME:
+			self.backoff[index] = 0
+		else:
+			self.backoff[index] = min(self.MAX_BACKOFF, max(1, self.backoff.get(index, 0) * 2))
+		return self.backoff[index]
+
+	def run(self):
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		# Only there to interrupt waitpid
+		signal.signal(signal.SIGALRM, lambda signum, frame: None)
+
+		for index in range(self.workers):
+			self.spawn(index)
+
+		pending = []
+		while not self.stopping:
+			# Restart workers whose backoff is over
+			now = time.time()
+			for due, index in list(pending):
+				if due <= now:
+					pending.remove((due, index))
+					self.spawn(index)
+
+			if pending:
+				# Poll, so that a pending restart is not missed
+				signal.alarm(1)
+			result = self.reap()
+			signal.alarm(0)
+			if not result or not result[0] in self.children:
+				continue
+
+			pid, status = result
+			index = self.children.pop(pid)
+			if self.stopping:
+				break
+
+			delay = self.restart_delay(index)
+			logger.warn('Worker %s (pid %s) exited with status %s, restarting in %s seconds' % (index, pid, status, delay))
+			pending.append((time.time() + delay, index))
+
+		self.drain()
+
+	def drain(self):
+		deadline = time.time() + self.drain_timeout
+		while self.children and time.time() < deadline:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except OSError, e:
+				if e.errno == errno.ECHILD:
+					break
+				if e.errno != errno.EINTR:
+					raise
+				continue
+
+			if pid:
+				logger.info('Worker %s (pid %s) stopped' % (self.children.pop(pid, None), pid))
+			else:
+				time.sleep(0.5)
+
+		for pid in list(self.children):
+			logger.warn('Worker pid %s did not drain in time, killing it' % pid)
+			try:
+				os.kill(pid, signal.SIGKILL)
+			except OSError:
+				pass
+		logger.info('Supervisor stopped')
+
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	workers = args.workers
+	if not workers:
+		workers = 1 if args.pipeline else multiprocessing.cpu_count()
+
+	Supervisor(args, workers, args.drain_timeout).run()
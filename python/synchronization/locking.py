@@ -4,79 +4,358 @@
 import sys, os, traceback
 sys.path.append("..")
 
-from redis import WatchError
+import threading, uuid
 
 import config_utils
 from dao.dictsearchstore import *
+from synchronization.sharding import shard_for
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+# Atomically lease up to count of the stalest unlocked app_ids in the
+# frontier. A leased app_id is pushed lease ms into the future, so it
+# becomes due again by itself if its lease is never renewed.
+#
+# KEYS[1] -- frontier sorted set, app_id scored by when it is next due
+# ARGV    -- now, lease ms, owner, lock prefix, count, candidates to try
+CLAIM_SCRIPT = """
+local now = tonumber(ARGV[1])
+local lease = tonumber(ARGV[2])
+local count = tonumber(ARGV[5])
+local claimed = {}
+local candidates = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[6]))
+for _, app_id in ipairs(candidates) do
+	if redis.call('SET', ARGV[4] .. ':' .. app_id, ARGV[3], 'NX', 'PX', lease) then
+		redis.call('ZADD', KEYS[1], now + lease, app_id)
+		claimed[#claimed + 1] = app_id
+		if #claimed >= count then
+			break
+		end
+	end
+end
+return claimed
+"""
+
+# Extend the leases that owner still holds. Returns the renewed app_ids.
+#
+# KEYS[1] -- frontier sorted set
+# ARGV    -- now, lease ms, owner, lock prefix, app_ids...
+RENEW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local lease = tonumber(ARGV[2])
+local renewed = {}
+for i = 5, #ARGV do
+	local lock_name = ARGV[4] .. ':' .. ARGV[i]
+	if redis.call('GET', lock_name) == ARGV[3] then
+		redis.call('PEXPIRE', lock_name, lease)
+		redis.call('ZADD', KEYS[1], now + lease, ARGV[i])
+		renewed[#renewed + 1] = ARGV[i]
+	end
+end
+return renewed
+"""
+
+# Drop the leases that owner still holds and schedule the app_ids.
+# With a last fetched time, the app hash is stamped as well.
+#
+# KEYS[1] -- frontier sorted set
+# KEYS[2] -- app hash, app_id to last fetched time
+# ARGV    -- due, last fetched time or '', owner, lock prefix, app_ids...
+FINISH_SCRIPT = """
+local finished = 0
+for i = 5, #ARGV do
+	local lock_name = ARGV[4] .. ':' .. ARGV[i]
+	if redis.call('GET', lock_name) == ARGV[3] then
+		redis.call('DEL', lock_name)
+		redis.call('ZADD', KEYS[1], tonumber(ARGV[1]), ARGV[i])
+		if ARGV[2] ~= '' then
+			redis.call('HSET', KEYS[2], ARGV[i], ARGV[2])
+		end
+		finished = finished + 1
+	end
+end
+return finished
+"""
+
+
 class ApplicationIdLocker(object):
 	"""Handles locking/unlocking of app_ids so that multiple
 	fetchers don't fetch the same app_id.
 
+	App ids wait in a frontier, a sorted set scored by the time each
+	app is next due to be fetched. Claiming leases the most overdue
+	apps that are not locked, in one round trip and O(log n) no matter
+	how many app ids there are.
+
+	Leases only last ttl seconds. While work is in progress, a
+	heartbeat thread renews every lease this locker holds, so long
+	analyses keep their app ids, while the app ids of a crashed worker
+	go back to the frontier within seconds.
+
 	Invokers want to use:
+		- start_heartbeat()
+		- claim(count)
+		- complete(app_id) or release(app_id)
+
+	or, for one app_id at a time:
 		- set_lock_get_id()
 		- unlock()
 
-	You definitely want to put unlock() in a finally.
+	You definitely want to put complete() or unlock() in a finally.
+
+	Completed app ids are due again after revisit_interval, or after
+	the interval a RevisitPolicy picks for each of them.
+
+	With shards, the frontier is split into that many sorted sets, and
+	an app_id always lives in the same one (see shard_for). Claims go
+	to the shards a ShardMembership says this node owns, or round robin
+	over every shard without one, so nodes don't contend on one key.
+	Once the owned shards run dry, the rest are claimed from as well, so
+	no node sits idle while other shards still have due app ids.
 	"""
 
-	def __init__(self, db, alphabet=AlphabetType.en_US, ttl=3600):
+	def __init__(self, db, alphabet=AlphabetType.en_US, ttl=30, revisit_interval=604800000, candidates=20,
+				 revisit_policy=None, shards=0, membership=None):
 		self.alphabet = alphabet
 		self.db = db
 		self.app_id = None
 		self.ttl = ttl
+		self.revisit_interval = revisit_interval
+		self.candidates = candidates
+		self.revisit_policy = revisit_policy
+		self.shards = shards
+		self.membership = membership
+		self.next_shard = 0
+		self.owner = uuid.uuid4().hex
+		self.held = set()
+		self.held_lock = threading.Lock()
+		self.heartbeat = None
+		self.heartbeat_stop = threading.Event()
+		self.claim_script = self.db.register_script(CLAIM_SCRIPT)
+		self.renew_script = self.db.register_script(RENEW_SCRIPT)
+		self.finish_script = self.db.register_script(FINISH_SCRIPT)
 
-	def __lock_app_id(self, key, field, value):
-		"""Get a simple lock on a specific app_id in Redis."""
-		lock_name = ':'.join((self.alphabet.lock_prefix(), field))
-
-		logger.info('Lock name: %s' % lock_name)
-
-		# Check lock. If not locked, get lock.
-		lock_result = self.db.set(lock_name, 1, nx=True, ex=self.ttl)
-		logger.debug('Lock result for key %s: %s' % (key, lock_result))
-		if not lock_result:
-			return False
-
-		try:
-			with self.db.pipeline() as pipe:
-				pipe.watch(lock_name)
-				pipe.multi()
-				pipe.hset(key, field, config_utils.current_time_millis())
-				pipe.execute()
-				return True
-		except WatchError:
-				return False
+	def lease_ms(self):
+		return int(self.ttl * 1000)
 
 	def need_fetch(self, value):
 		"""Checks if the app_id timestamp is 0 (never fetched) or old."""
 		value = int(value)
-		return value == 0 or value < config_utils.current_time_millis() - 604800000
+		return value == 0 or value < config_utils.current_time_millis() - self.revisit_interval
+
+	def rotate(self, shards):
+		"""shards, starting where the last claim left off, so that
+		shards are drained evenly.
+		"""
+		if not shards:
+			return shards
+		start = self.next_shard % len(shards)
+		return shards[start:] + shards[:start]
+
+	def frontier_shards(self):
+		"""The shards to claim from in order, [None] if there are none:
+		the shards this node owns, then every other shard.
+		"""
+		if not self.shards:
+			return [ None ]
+		if not self.membership:
+			return self.rotate(range(self.shards))
+
+		owned = self.membership.owned_shards()
+		others = sorted(set(range(self.shards)) - set(owned))
+		return self.rotate(owned) + self.rotate(others)
+
+	def by_shard(self, app_ids):
+		"""Group app_ids into { shard: [app_id] }."""
+		groups = {}
+		for app_id in app_ids:
+			groups.setdefault(shard_for(app_id, self.shards), []).append(app_id)
+		return groups
+
+	def claim(self, count=1):
+		"""Lease up to count app_ids that aren't currently locked for
+		fetching. Returns the list of leased app_ids.
+		"""
+		app_ids = []
+		for shard in self.frontier_shards():
+			wanted = count - len(app_ids)
+			app_ids.extend(self.claim_script(
+				keys=[self.alphabet.frontier_name(shard)],
+				args=[config_utils.current_time_millis(), self.lease_ms(), self.owner,
+					  self.alphabet.lock_prefix(shard), wanted, max(self.candidates, wanted * 2)]))
+			if len(app_ids) >= count:
+				break
+		self.next_shard += 1
+
+		with self.held_lock:
+			self.held.update(app_ids)
+
+		logger.info('Leased %s app_ids: %s' % (len(app_ids), app_ids))
+		return app_ids
+
+	def renew(self):
+		"""Extend the lease on every app_id this locker holds.
+
+		Returns the app_ids whose leases were lost.
+		"""
+		with self.held_lock:
+			held = list(self.held)
+		if not held:
+			return []
+
+		renewed = []
+		for shard, app_ids in self.by_shard(held).items():
+			renewed.extend(self.renew_script(
+				keys=[self.alphabet.frontier_name(shard)],
+				args=[config_utils.current_time_millis(), self.lease_ms(), self.owner,
+					  self.alphabet.lock_prefix(shard)] + app_ids))
+
+		lost = set(held) - set(renewed)
+		if lost:
+			with self.held_lock:
+				self.held.difference_update(lost)
+			logger.warn('Lost leases on: %s' % list(lost))
+		return list(lost)
+
+	def __finish(self, app_ids, due, fetched_time=''):
+		if not app_ids:
+			return 0
+		with self.held_lock:
+			self.held.difference_update(app_ids)
+
+		finished = 0
+		for shard, shard_app_ids in self.by_shard(app_ids).items():
+			finished += self.finish_script(
+				keys=[self.alphabet.frontier_name(shard), self.alphabet.name],
+				args=[due, fetched_time, self.owner, self.alphabet.lock_prefix(shard)] + shard_app_ids)
+		return finished
+
+	def revisit_intervals(self, app_ids):
+		"""Returns { app_id: ms until it is due again }."""
+		if self.revisit_policy:
+			return self.revisit_policy.intervals(app_ids)
+		return dict((app_id, self.revisit_interval) for app_id in app_ids)
+
+	def complete(self, *app_ids):
+		"""Drop the leases on app_ids, recording them as fetched just
+		now. They are due again after their revisit interval.
+		"""
+		now = config_utils.current_time_millis()
+		if not self.revisit_policy:
+			return self.__finish(app_ids, now + self.revisit_interval, now)
+
+		finished = 0
+		for app_id, interval in self.revisit_intervals(app_ids).items():
+			finished += self.__finish([app_id], now + interval, now)
+		return finished
+
+	def release(self, *app_ids):
+		"""Drop the leases on app_ids without fetching them. They are
+		due again right away.
+		"""
+		return self.__finish(app_ids, config_utils.current_time_millis())
+
+	def __heartbeat(self):
+		while not self.heartbeat_stop.wait(self.ttl / 3.0):
+			try:
+				self.renew()
+			except Exception:
+				logger.exception('Failed to renew leases')
+
+	def start_heartbeat(self):
+		"""Renew held leases in a background thread every third of ttl."""
+		if self.heartbeat:
+			return
+		self.heartbeat_stop.clear()
+		self.heartbeat = threading.Thread(target=self.__heartbeat, name='lease-heartbeat')
+		self.heartbeat.daemon = True
+		self.heartbeat.start()
+
+	def stop_heartbeat(self):
+		if not self.heartbeat:
+			return
+		self.heartbeat_stop.set()
+		self.heartbeat.join()
+		self.heartbeat = None
 
 	def set_lock_get_id(self):
 		"""Get an app_id that isn't currently locked for fetching."""
-		key = self.alphabet.name
+		app_ids = self.claim(1)
+		if app_ids:
+			logger.info('Got app_id lock: %s', app_ids[0])
+			self.app_id = app_ids[0]
+			return self.app_id
+
+		self.app_id = None
+		logger.warn('Could not find any unlocked and/or stale app_id!')
 
-		for field, value in self.db.hscan_iter(key, count=20):
-			# Check if value is stale
-			if self.need_fetch(value) and self.__lock_app_id(key, field, value):
-				logger.info('Got app_id lock: %s', field)
-				self.app_id = field
-				return field
+	def mark_fetched(self, app_ids):
+		"""Record app_ids as fetched just now, without locking them,
+		and push them to the back of the frontier.
+		"""
+		now = config_utils.current_time_millis()
+		intervals = self.revisit_intervals(app_ids)
+		with self.db.pipeline() as pipe:
+			for app_id in app_ids:
+				pipe.hset(self.alphabet.name, app_id, now)
+				pipe.execute_command('ZADD', self.alphabet.frontier_name(shard_for(app_id, self.shards)),
+									 now + intervals[app_id], app_id)
+			return pipe.execute()
 
-			logger.debug('App_id %s was locked. Trying next...' % field)
+	def sync_frontier(self, count=1000):
+		"""Add every app_id in the app hash that is missing from the
+		frontier, due revisit_interval after it was last fetched.
 
-		logger.warn('Could not find any unlocked and/or stale app_id!')
+		Only needed once for app hashes that predate the frontier.
+		Returns the number of app ids added.
+		"""
+		added = 0
+		pipe = self.db.pipeline()
+		for i, (field, value) in enumerate(self.db.hscan_iter(self.alphabet.name, count=count)):
+			value = int(value)
+			due = value + self.revisit_interval if value else 0
+			pipe.execute_command('ZADD', self.alphabet.frontier_name(shard_for(field, self.shards)), 'NX', due, field)
+
+			if not (i + 1) % count:
+				added += sum(pipe.execute())
+		added += sum(pipe.execute())
+		logger.info('Added %s app ids to %s' % (added, self.alphabet.frontier_name()))
+		return added
+
+	def shard_frontier(self, count=1000):
+		"""Move every app_id in the unsharded frontier into its shard,
+		keeping its due time.
+
+		Only needed once when turning on sharding. Returns the number
+		of app ids moved.
+		"""
+		if not self.shards:
+			raise ValueError('Cannot shard the frontier of a locker without shards')
+
+		moved = 0
+		legacy = self.alphabet.frontier_name()
+		while True:
+			batch = self.db.zrange(legacy, 0, count - 1, withscores=True)
+			if not batch:
+				break
+			with self.db.pipeline() as pipe:
+				for app_id, due in batch:
+					pipe.execute_command('ZADD', self.alphabet.frontier_name(shard_for(app_id, self.shards)),
+										 'NX', due, app_id)
+				pipe.zrem(legacy, *[ app_id for app_id, due in batch ])
+				pipe.execute()
+			moved += len(batch)
+		logger.info('Moved %s app ids from %s into %s shards' % (moved, legacy, self.shards))
+		return moved
 
 	def unlock(self):
-		"""Release the lock on an app_id."""
+		"""Release the lock on an app_id, recording it as fetched."""
 		if not self.app_id:
 			return
 
-		lock_name = ':'.join((self.alphabet.lock_prefix(), self.app_id))
-		result = self.db.delete(lock_name)
-		logger.info('Attempted release of lock: %s (result: %s)' % (lock_name, result))
-		return result
\ No newline at end of file
+		result = self.complete(self.app_id)
+		logger.info('Attempted release of lock: %s (result: %s)' % (self.app_id, result))
+		self.app_id = None
+		return result
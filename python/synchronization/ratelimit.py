@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os, traceback
+sys.path.append("..")
+
+import threading
+import time
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+RATE_LIMIT_CONFIG_KEY = 'rate_limit_config'
+RATE_LIMIT_PREFIX = 'ratelimit'
+
+# The endpoints every crawler process may share a bucket for
+RATE_LIMITED_ENDPOINTS = ('crawl_point', 'fetch_point', 'detail_page')
+
+# Time comes from the Redis server, so that clock skew between crawler
+# hosts can't starve the ones that run behind. Reading TIME before a
+# write needs effects replication on Redis before 5.
+NOW_MS = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+"""
+
+# Take tokens from a bucket shared by every process, refilling it for
+# the time since it was last used. If the bucket backed off, its rate
+# climbs back by step tokens/s per second once it has been quiet for a
+# while. Returns the seconds to wait (0 if the tokens were taken) as a
+# string, since Lua numbers are truncated to integers on return.
+#
+# KEYS[1] -- bucket hash: tokens, updated, rate, penalized, blocked
+# ARGV    -- tokens, rate, capacity, step, quiet ms, expire ms
+ACQUIRE_SCRIPT = NOW_MS + """
+local wanted = tonumber(ARGV[1])
+local max_rate = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated', 'rate', 'penalized', 'blocked')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+local rate = math.min(tonumber(state[3]) or max_rate, max_rate)
+local elapsed = math.max(0, now - updated) / 1000
+if rate < max_rate and now - (tonumber(state[4]) or 0) >= tonumber(ARGV[5]) then
+	rate = math.min(max_rate, rate + tonumber(ARGV[4]) * elapsed)
+end
+tokens = math.min(capacity, tokens + elapsed * rate)
+local wait = 0
+local blocked = tonumber(state[5]) or 0
+if now < blocked then
+	wait = (blocked - now) / 1000
+elseif tokens >= wanted then
+	tokens = tokens - wanted
+else
+	wait = (wanted - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', math.max(now, updated), 'rate', rate)
+redis.call('PEXPIRE', KEYS[1], ARGV[6])
+return tostring(wait)
+"""
+
+# Slow a shared bucket down after the endpoint pushed back. The rate
+# drops at most once per token at the current rate, so a burst of
+# failures from many processes only counts once. A Retry-After stops
+# every process until it has passed. Returns the new rate as a string.
+#
+# KEYS[1] -- bucket hash
+# ARGV    -- backoff factor, min rate, rate, retry after ms, expire ms
+PENALIZE_SCRIPT = NOW_MS + """
+local state = redis.call('HMGET', KEYS[1], 'rate', 'penalized', 'blocked')
+local rate = math.min(tonumber(state[1]) or tonumber(ARGV[3]), tonumber(ARGV[3]))
+local retry_after = tonumber(ARGV[4])
+if retry_after > 0 then
+	redis.call('HSET', KEYS[1], 'blocked', math.max(tonumber(state[3]) or 0, now + retry_after))
+end
+if now - (tonumber(state[2]) or 0) >= 1000 / rate then
+	rate = math.max(tonumber(ARGV[2]), rate * tonumber(ARGV[1]))
+	redis.call('HMSET', KEYS[1], 'rate', rate, 'penalized', now)
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[5])
+return tostring(rate)
+"""
+
+
+class TokenBucket(object):
+	"""Thread-safe token bucket used to pace requests against an
+	endpoint instead of sleeping a fixed amount between them.
+
+	rate is the number of tokens added per second, and capacity is
+	the largest burst that may be spent at once. Invokers want to use:
+		- acquire()
+	"""
+
+	def __init__(self, rate=1/3.0, capacity=1):
+		if rate <= 0:
+			raise ValueError('TokenBucket rate must be positive: %s' % rate)
+		if capacity < 1:
+			raise ValueError('TokenBucket capacity must be at least 1: %s' % capacity)
+
+		self.rate = float(rate)
+		self.capacity = float(capacity)
+		self.tokens = float(capacity)
+		self.updated = time.time()
+		self.lock = threading.Lock()
+
+	def __refill(self, now):
+		elapsed = now - self.updated
+		if elapsed > 0:
+			self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+			self.updated = now
+
+	def try_acquire(self, tokens=1):
+		"""Take tokens if they are available right now.
+
+		Returns 0 on success, otherwise the number of seconds to wait
+		before the requested tokens will be available.
+		"""
+		with self.lock:
+			self.__refill(time.time())
+			if self.tokens >= tokens:
+				self.tokens -= tokens
+				return 0
+			return (tokens - self.tokens) / self.rate
+
+	def acquire(self, tokens=1):
+		"""Block until tokens are available, then take them.
+
+		Returns the total number of seconds spent waiting.
+		"""
+		waited = 0
+		while True:
+			wait = self.try_acquire(tokens)
+			if not wait:
+				return waited
+			logger.debug('Rate limited, waiting %.3f seconds' % wait)
+			time.sleep(wait)
+			waited += wait
+
+
+class DistributedTokenBucket(object):
+	"""Token bucket kept in Redis, so that every crawler process that
+	uses the same name draws from one budget. The request rate against
+	an endpoint then stays the same no matter how many processes run.
+
+	In adaptive mode, observe() is told about every response. After a
+	429 or 5xx response the rate is multiplied by backoff, down to
+	min_rate, and a Retry-After pauses the bucket for everyone. Once
+	there have been no such responses for quiet seconds, the rate climbs
+	back to rate over ramp_time seconds.
+
+	Invokers want to use:
+		- acquire()
+		- observe(status, retry_after) after each response
+	"""
+
+	THROTTLE_STATUSES = (429,)
+
+	def __init__(self, db, name, rate=1/3.0, capacity=1, adaptive=False, min_rate=None, backoff=0.5,
+				 quiet=30, ramp_time=300, expire=3600):
+		"""Initialize the bucket.
+
+		Keyword arguments:
+		db -- Redis instance shared by all processes.
+		name -- Bucket name, usually the endpoint's configuration key.
+		rate -- Tokens added per second, across all processes. (default 1/3.0)
+		capacity -- Largest burst that may be spent at once. (default 1)
+		adaptive -- Back off on 429/5xx responses. (default False)
+		min_rate -- Lowest rate to back off to. (default rate / 10)
+		backoff -- Factor the rate is multiplied by on each backoff. (default 0.5)
+		quiet -- Seconds without 429/5xx before the rate climbs back. (default 30)
+		ramp_time -- Seconds to climb from min_rate back to rate. (default 300)
+		expire -- Seconds an unused bucket is kept in Redis. (default 3600)
+		"""
+		if rate <= 0:
+			raise ValueError('DistributedTokenBucket rate must be positive: %s' % rate)
+		if capacity < 1:
+			raise ValueError('DistributedTokenBucket capacity must be at least 1: %s' % capacity)
+		if not 0 < backoff < 1:
+			raise ValueError('DistributedTokenBucket backoff must be between 0 and 1: %s' % backoff)
+
+		self.db = db
+		self.name = name
+		self.rate = float(rate)
+		self.capacity = float(capacity)
+		self.adaptive = adaptive
+		self.min_rate = float(min_rate) if min_rate else self.rate / 10
+		self.backoff = backoff
+		self.quiet = quiet
+		self.step = (self.rate - self.min_rate) / ramp_time if adaptive else 0
+		self.expire = expire
+		self.acquire_script = self.db.register_script(ACQUIRE_SCRIPT)
+		self.penalize_script = self.db.register_script(PENALIZE_SCRIPT)
+
+	def key(self):
+		return '%s:%s' % (RATE_LIMIT_PREFIX, self.name)
+
+	def try_acquire(self, tokens=1):
+		"""Take tokens if they are available right now.
+
+		Returns 0 on success, otherwise the number of seconds to wait
+		before trying again.
+		"""
+		return float(self.acquire_script(
+			keys=[self.key()],
+			args=[tokens, self.rate, self.capacity, self.step,
+				  int(self.quiet * 1000), int(self.expire * 1000)]))
+
+	def acquire(self, tokens=1):
+		"""Block until tokens are available, then take them.
+
+		Returns the total number of seconds spent waiting.
+		"""
+		waited = 0
+		while True:
+			wait = self.try_acquire(tokens)
+			if not wait:
+				return waited
+			logger.debug('Rate limited on %s, waiting %.3f seconds' % (self.name, wait))
+			time.sleep(wait)
+			waited += wait
+
+	def is_throttled(self, status):
+		return status in self.THROTTLE_STATUSES or status >= 500
+
+	def observe(self, status, retry_after=None):
+		"""Record the status of a response from this bucket's endpoint,
+		backing off if it was a 429 or 5xx. Does nothing unless adaptive.
+
+		Returns the bucket's rate after the response.
+		"""
+		if not self.adaptive or not self.is_throttled(status):
+			return None
+
+		rate = float(self.penalize_script(
+			keys=[self.key()],
+			args=[self.backoff, self.min_rate, self.rate,
+				  int((retry_after or 0) * 1000), int(self.expire * 1000)]))
+		logger.warn('%s responded %s, backing off to %.3f requests/s' % (self.name, status, rate))
+		return rate
+
+	def current_rate(self):
+		"""The rate the bucket is refilling at right now."""
+		rate = self.db.hget(self.key(), 'rate')
+		return float(rate) if rate is not None else self.rate
+
+
+def rate_limiters_from_config(config, db, key=RATE_LIMIT_CONFIG_KEY):
+	"""Build a DistributedTokenBucket for each endpoint in the optional
+	rate_limit_config section of the configuration file.
+
+	The section looks like
+		{ "adaptive": true, "endpoints": { "crawl_point": { "rate": 0.33 }, ... } }
+	and everything besides endpoints is passed to every bucket.
+
+	Returns { endpoint: DistributedTokenBucket }, empty if there is no
+	such section.
+	"""
+	rate_config = dict(config.get(key, {}))
+	endpoints = rate_config.pop('endpoints', {})
+
+	limiters = {}
+	for endpoint, endpoint_config in endpoints.items():
+		if endpoint not in RATE_LIMITED_ENDPOINTS:
+			raise ValueError('Unknown rate limited endpoint: %s' % endpoint)
+		settings = dict(rate_config)
+		settings.update(endpoint_config)
+		limiters[endpoint] = DistributedTokenBucket(db, endpoint, **settings)
+	return limiters
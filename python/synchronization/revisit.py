@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append("..")
+
+import json, math
+import logging
+
+import config_utils
+from dao.dictsearchstore import AlphabetType
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+REVISIT_CONFIG_KEY = 'revisit_config'
+
+
+class RevisitPolicy(object):
+	"""Picks how long to wait before fetching each app again, from how
+	often it changed when it was fetched before.
+
+	Every fetch is recorded as an observation: whether the app changed
+	(a new commit) or not (nothing to commit, a 304 or an unchanged
+	version) since the previous fetch. Changes are assumed to follow a
+	Poisson process, whose rate is estimated from n observations with
+	x changes over a mean interval I as
+
+		rate = -ln((n - x + 0.5) / (n + 0.5)) / I
+
+	which, unlike x / (n * I), does not assume every changed fetch
+	saw exactly one change.
+
+	The next revisit is due once the app has changed with probability
+	target, clamped to [min_interval, max_interval]. Apps with fewer
+	than min_checks observations use default_interval. With a
+	downloads_weight, intervals shrink for popular apps, by a factor of
+	(1 + log10(1 + downloads)) ** downloads_weight, taking downloads
+	from the metadata the discoverer harvested.
+	"""
+
+	def __init__(self, db, alphabet=AlphabetType.en_US, default_interval=604800000, min_interval=86400000,
+				 max_interval=2592000000, target=0.5, min_checks=2, downloads_weight=0):
+		if not 0 < target < 1:
+			raise ValueError('RevisitPolicy target must be between 0 and 1: %s' % target)
+
+		self.db = db
+		self.alphabet = alphabet
+		self.default_interval = default_interval
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.target = target
+		self.min_checks = min_checks
+		self.downloads_weight = downloads_weight
+
+	def histories(self, app_ids):
+		"""Returns the observation history of every app id, in order."""
+		if not app_ids:
+			return []
+		values = self.db.hmget(self.alphabet.revisits_name(), app_ids)
+		return [ json.loads(value) if value else {} for value in values ]
+
+	def observe_many(self, app_ids, changed, now=None):
+		"""Record that app_ids were fetched at now, and whether they
+		changed since they were last fetched.
+		"""
+		now = now or config_utils.current_time_millis()
+		app_ids = list(app_ids)
+
+		with self.db.pipeline() as pipe:
+			for app_id, history in zip(app_ids, self.histories(app_ids)):
+				last_check = history.get('last_check')
+				if last_check and now > last_check:
+					history['checks'] = history.get('checks', 0) + 1
+					history['changes'] = history.get('changes', 0) + (1 if changed else 0)
+					history['elapsed'] = history.get('elapsed', 0) + now - last_check
+				history['last_check'] = now
+				pipe.hset(self.alphabet.revisits_name(), app_id, json.dumps(history))
+			pipe.execute()
+
+	def observe(self, app_id, changed, now=None):
+		self.observe_many([app_id], changed, now)
+
+	def change_rate(self, history):
+		"""Estimated changes per ms, or None with too few observations."""
+		checks = history.get('checks', 0)
+		if checks < self.min_checks or not history.get('elapsed'):
+			return None
+
+		mean_interval = float(history['elapsed']) / checks
+		unchanged = checks - history.get('changes', 0)
+		return -math.log((unchanged + 0.5) / (checks + 0.5)) / mean_interval
+
+	def interval_for(self, history, downloads=None):
+		"""Revisit interval in ms for an app with history."""
+		rate = self.change_rate(history)
+		if rate is None:
+			interval = self.default_interval
+		elif rate <= 0:
+			interval = self.max_interval
+		else:
+			interval = -math.log(1 - self.target) / rate
+
+		if self.downloads_weight and downloads:
+			interval /= (1 + math.log10(1 + downloads)) ** self.downloads_weight
+
+		return int(max(self.min_interval, min(self.max_interval, interval)))
+
+	def downloads(self, app_ids):
+		"""Harvested download counts of app_ids, None where unknown."""
+		if not self.downloads_weight:
+			return [ None ] * len(app_ids)
+
+		downloads = []
+		for value in self.db.hmget(self.alphabet.meta_name(), app_ids):
+			try:
+				downloads.append(json.loads(value).get('downloads') if value else None)
+			except ValueError:
+				downloads.append(None)
+		return downloads
+
+	def intervals(self, app_ids):
+		"""Returns { app_id: revisit interval in ms }."""
+		app_ids = list(app_ids)
+		if not app_ids:
+			return {}
+		return dict((app_id, self.interval_for(history, downloads))
+					for app_id, history, downloads
+					in zip(app_ids, self.histories(app_ids), self.downloads(app_ids)))
+
+
+def revisit_policy_from_config(config, db, alphabet=AlphabetType.en_US, key=REVISIT_CONFIG_KEY):
+	"""Build a RevisitPolicy from the optional revisit_config section
+	of the configuration file, or None if there isn't one.
+	"""
+	revisit_config = config.get(key)
+	if not revisit_config:
+		return None
+	return RevisitPolicy(db, alphabet=alphabet, **revisit_config)
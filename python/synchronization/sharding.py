@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append("..")
+
+import hashlib, socket, threading, uuid, zlib
+import logging
+
+from dao.dictsearchstore import AlphabetType
+from synchronization.ratelimit import NOW_MS
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+SHARDING_CONFIG_KEY = 'sharding_config'
+
+# Heartbeat a node and drop the nodes whose last heartbeat is older
+# than the ttl, all by the Redis server's clock, so that nodes with
+# skewed clocks don't evict each other. Returns the live nodes.
+#
+# KEYS[1] -- sorted set of nodes by last heartbeat
+# ARGV    -- node id, ttl ms
+HEARTBEAT_SCRIPT = NOW_MS + """
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[2]))
+return redis.call('ZRANGE', KEYS[1], 0, -1)
+"""
+
+
+def shard_for(app_id, shards):
+	"""The frontier shard of app_id, or None if the frontier isn't
+	sharded (shards is 0 or None).
+	"""
+	if not shards:
+		return None
+	return (zlib.crc32(app_id) & 0xffffffff) % shards
+
+
+def shards_from_config(config, key=SHARDING_CONFIG_KEY):
+	"""Number of frontier shards in the optional sharding_config
+	section of the configuration file, 0 for an unsharded frontier.
+	"""
+	return config.get(key, {}).get('shards', 0)
+
+
+def membership_from_config(config, db, alphabet=AlphabetType.en_US, key=SHARDING_CONFIG_KEY):
+	"""Build a ShardMembership from the optional sharding_config
+	section of the configuration file, or None if there isn't one.
+	"""
+	sharding_config = config.get(key, {})
+	if not sharding_config.get('shards'):
+		return None
+	return ShardMembership(db, alphabet=alphabet, shards=sharding_config['shards'],
+						   ttl=sharding_config.get('ttl', 30))
+
+
+def ring_hash(key):
+	return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class ShardAssignment(object):
+	"""Splits shards between nodes by rendezvous hashing with bounded
+	loads, so that every node that sees the same set of nodes computes
+	the same assignment.
+
+	Every shard ranks the nodes by the hash of (node, shard) and goes
+	to the highest ranked node that still has room. Nodes have room for
+	shards / len(nodes) shards, and the remainder goes one each to the
+	nodes that rank highest for it, so no two nodes own more than one
+	shard apart, and no node owns none while there are at least as
+	many shards as nodes. Most shards stay with their first choice, but
+	the bounded loads push some others along when a node joins or
+	leaves: with 64 shards, a node leaving 16 moved about 9 shards on
+	average, against the 4 it owned.
+	"""
+
+	def __init__(self, nodes, shards):
+		self.nodes = sorted(set(nodes))
+		self.shards = shards
+		self.owners = {}
+		if not self.nodes:
+			return
+
+		quota, remainder = divmod(shards, len(self.nodes))
+		by_rank = sorted(self.nodes, key=lambda node: ring_hash('%s#remainder' % node), reverse=True)
+		room = dict((node, quota + (1 if i < remainder else 0)) for i, node in enumerate(by_rank))
+
+		for shard in range(shards):
+			ranked = sorted(self.nodes, key=lambda node: ring_hash('%s#%s' % (node, shard)), reverse=True)
+			for node in ranked:
+				if room[node]:
+					room[node] -= 1
+					self.owners[shard] = node
+					break
+
+	def node_for(self, shard):
+		return self.owners.get(shard)
+
+	def shards_for(self, node):
+		"""The shards out of range(shards) that node owns."""
+		return [ shard for shard in range(self.shards) if self.owners.get(shard) == node ]
+
+
+class ShardMembership(object):
+	"""Membership of one crawler node in the ShardAssignment that splits
+	the frontier shards between nodes. Every driver process is a node.
+
+	Every node heartbeats into a sorted set in Redis, timed by the Redis
+	server's clock. Nodes that miss their heartbeats for ttl seconds
+	drop out, and every node recomputes which shards it owns on each
+	heartbeat, so shards are rebalanced within about ttl seconds of a
+	node joining or leaving. While a
+	rebalance settles two nodes may claim from the same shard, which the
+	app_id locks make safe.
+	"""
+
+	def __init__(self, db, alphabet=AlphabetType.en_US, shards=64, node_id=None, ttl=30):
+		self.db = db
+		self.alphabet = alphabet
+		self.shards = shards
+		self.node_id = node_id or '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+		self.ttl = ttl
+		self.owned = range(shards)
+		self.owned_lock = threading.Lock()
+		self.heartbeat_thread = None
+		self.heartbeat_stop = threading.Event()
+		self.heartbeat_script = self.db.register_script(HEARTBEAT_SCRIPT)
+
+	def heartbeat(self):
+		"""Refresh this node's membership, drop dead nodes and recompute
+		the shards this node owns. Returns the owned shards.
+		"""
+		nodes = self.heartbeat_script(keys=[self.alphabet.nodes_name()],
+									  args=[self.node_id, int(self.ttl * 1000)])
+
+		owned = ShardAssignment(nodes, self.shards).shards_for(self.node_id)
+		with self.owned_lock:
+			if owned != self.owned:
+				logger.info('Node %s now owns %s of %s shards (%s nodes)'
+							% (self.node_id, len(owned), self.shards, len(nodes)))
+			self.owned = owned
+		return owned
+
+	def owned_shards(self):
+		with self.owned_lock:
+			return list(self.owned)
+
+	def __heartbeat(self):
+		while not self.heartbeat_stop.wait(self.ttl / 3.0):
+			try:
+				self.heartbeat()
+			except Exception:
+				logger.exception('Failed to heartbeat node membership')
+
+	def start(self):
+		"""Join the nodes and heartbeat every third of ttl."""
+		if self.heartbeat_thread:
+			return
+		self.heartbeat()
+		self.heartbeat_stop.clear()
+		self.heartbeat_thread = threading.Thread(target=self.__heartbeat, name='membership-heartbeat')
+		self.heartbeat_thread.daemon = True
+		self.heartbeat_thread.start()
+
+	def stop(self):
+		"""Leave the nodes, so that other nodes take over right away."""
+		if self.heartbeat_thread:
+			self.heartbeat_stop.set()
+			self.heartbeat_thread.join()
+			self.heartbeat_thread = None
+		self.db.zrem(self.alphabet.nodes_name(), self.node_id)
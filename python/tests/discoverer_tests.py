@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import unittest
+import demjson
+
+from crawler.discoverer import WebStoreParser
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name):
+	with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+		return f.read()
+
+
+def demjson_decode(body):
+	"""The payload of body the way the old parser decoded it, with the
+	empty array slots demjson leaves undefined as None.
+	"""
+	def nulls(value):
+		if value is demjson.undefined:
+			return None
+		if isinstance(value, list):
+			return [ nulls(item) for item in value ]
+		return value
+	return nulls(demjson.decode(body[body.find('['):]))
+
+
+class WebStoreParserTest(unittest.TestCase):
+	"""WebStoreParser.decode has to decode crawl_point responses the
+	same way demjson does.
+	"""
+
+	def setUp(self):
+		self.parser = WebStoreParser()
+
+	def test_search_response(self):
+		# Synthetic response, not captured from the store, with empty
+		# slots inside items, nested arrays and string literals that
+		# look like elisions
+		body = read_fixture('synthetic_search_response.txt')
+		self.assertEqual(self.parser.decode(body), demjson_decode(body))
+		self.assertEqual(self.parser.stats['elisions'], 1)
+
+	def test_parse_search_response(self):
+		result = self.parser.parse_body(read_fixture('synthetic_search_response.txt'))
+		self.assertEqual(sorted(result.app_meta), ['aapbdbdomjkkjkaonfhkkikfgjllcleb',
+												   'edacconmaakjimmfgnblocblbcdcpbko',
+												   'pkedcjkdefgpdelpbcmbmeomcjbeemfm'])
+		self.assertEqual(result.token, ['52', '52'])
+
+	def test_elisions(self):
+		for payload in ['[1,,2]', '[,1]', '[1,]', '[1,,]', '[,]', '[]', '[[,],[,,]]',
+						'[1, ,2]', '["a,,b",,"[,]"]', '["\\\\",,"\\""]']:
+			body = ")]}'\n" + payload
+			self.assertEqual(self.parser.decode(body), demjson_decode(body), payload)
+
+	def test_strict_json(self):
+		body = ')]}\'\n[["a",1,null,[true]]]'
+		self.assertEqual(self.parser.decode(body), demjson_decode(body))
+		self.assertEqual(self.parser.stats['json'], 1)
+
+	def test_demjson_fallback(self):
+		# Left to demjson entirely, undefined slots and all
+		body = ")]}'\n[['single', 'quoted'],,1]"
+		self.assertEqual(self.parser.decode(body), demjson.decode(body[body.find('['):]))
+		self.assertEqual(self.parser.stats['demjson'], 1)
+
+	def test_not_an_array(self):
+		self.assertRaises(ValueError, self.parser.decode, '<html>Service Unavailable</html>')
+
+
+if __name__ == '__main__':
+	unittest.main()
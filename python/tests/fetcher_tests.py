@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import unittest
+
+from crawler.fetcher import MetadataFetcher, parse_itemprops
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name):
+	with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+		return f.read()
+
+
+class ParseTagsTest(unittest.TestCase):
+	"""parse_tags has to give the same AppMetadata as the
+	BeautifulSoup based parse_tags_legacy it replaced.
+	"""
+
+	APP_ID = 'edacconmaakjimmfgnblocblbcdcpbko'
+
+	def setUp(self):
+		self.fetcher = MetadataFetcher(base_url='')
+
+	def assertSameMetadata(self, page):
+		legacy = vars(self.fetcher.parse_tags_legacy(self.APP_ID, page))
+		fast = vars(self.fetcher.parse_tags(self.APP_ID, page))
+		del legacy['crawl_time'], fast['crawl_time']
+		self.assertEqual(legacy, fast)
+		return fast
+
+	def test_detail_page(self):
+		# Hand-built in the layout of a detail page, not a saved copy of
+		# one, with the itemprops nested in itemscopes of the body
+		metadata = self.assertSameMetadata(read_fixture('synthetic_detail_page.html'))
+		self.assertEqual(metadata['name'], 'Session Buddy')
+		self.assertEqual(metadata['version'], '3.6.4')
+		self.assertEqual(metadata['price'], 0.0)
+		self.assertEqual(metadata['price_currency'], 'USD')
+		self.assertEqual(metadata['downloads'], '1000000')
+		self.assertEqual(metadata['os'], 'Chrome')
+		self.assertEqual(metadata['rating_value'], 4.785714285714286)
+		self.assertEqual(metadata['rating_count'], 9123)
+
+	def test_itemprops_in_head(self):
+		# Every itemprop is in the head, so parsing stops before the body
+		head = ''.join('<meta itemprop="%s" content="%s">' % item for item in [
+			('name', 'Head App'), ('url', 'https://example.com/app'), ('version', '1.0'),
+			('price', '$1.99'), ('priceCurrency', 'EUR'), ('interactionCount', 'UserDownloads:512'),
+			('operatingSystems', 'Chrome'), ('ratingValue', '3.5'), ('ratingCount', '12') ])
+		page = '<html><head>%s</head><body>%s</body></html>' % (head, '<p>filler</p>' * 5000)
+
+		metadata = self.assertSameMetadata(page)
+		self.assertEqual(metadata['price'], 1.99)
+		self.assertEqual(metadata['downloads'], 512)
+		self.assertEqual(len(parse_itemprops(page, chunk_size=1024)), 9)
+
+	def test_markup_variants(self):
+		# Markup that real pages use but the fixture doesn't: content
+		# before itemprop, entities and character references, unquoted
+		# and upper case attributes, XHTML style tags, itemprops on
+		# elements other than meta and itemscopes nested in each other
+		page = '''<!DOCTYPE html><html><head>
+<META CONTENT="Tabs &amp; Windows &#8211; &quot;Pro&quot;" ITEMPROP="name">
+<meta content=https://example.com/app itemprop=url />
+</head><body>
+<div itemscope itemtype="http://schema.org/WebApplication">
+<span itemprop="name">Not a meta tag</span>
+<div itemprop="offers" itemscope><div itemprop="seller" itemscope>
+<meta itemprop="name" content="Nested &lt;Seller&gt;"></div>
+<meta itemprop='price' content='$0.99'/><meta itemprop="priceCurrency" content="GBP">
+</div>
+<meta itemprop="interactionCount" content="UserDownloads:2,048">
+<meta itemprop="ratingValue" content="4.0"><meta content="1,024" itemprop="ratingCount">
+<meta itemprop="version" content="">
+</div></body></html>'''
+
+		metadata = self.assertSameMetadata(page)
+		self.assertEqual(metadata['name'], u'Nested <Seller>')
+		self.assertEqual(metadata['url'], 'https://example.com/app')
+		self.assertEqual(metadata['price'], 0.99)
+		self.assertEqual(metadata['downloads'], 2048)
+		self.assertEqual(metadata['rating_count'], 1024)
+		self.assertEqual(metadata['version'], '')
+
+	def test_entities_in_head(self):
+		page = '<html><head><meta content="Caf&eacute; &amp; Tabs &#x2728;" itemprop="name"></head></html>'
+		metadata = self.assertSameMetadata(page)
+		self.assertEqual(metadata['name'], u'Caf\xe9 & Tabs \u2728')
+
+	def test_itemprop_without_content(self):
+		# parse_tags_legacy raised KeyError on these, parse_tags skips them
+		page = '<html><head><meta itemprop="image"><meta itemprop="name" content="App"></head></html>'
+		self.assertEqual(self.fetcher.parse_tags(self.APP_ID, page).name, 'App')
+
+	def test_no_itemprops(self):
+		metadata = self.assertSameMetadata('<html><head><meta name="description" content="x"></head></html>')
+		self.assertEqual(metadata['name'], None)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import redis
+import argparse, json, config_utils
+import time
+
+from dao.dictsearchstore import AlphabetType
+from crawler.updatecheck import *
+from crawler.http_session import session_from_config
+from synchronization.ratelimit import TokenBucket, rate_limiters_from_config
+from synchronization.revisit import revisit_policy_from_config
+from synchronization.sharding import shards_from_config
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(description='driver for batched version checks ahead of fetching')
+parser.add_argument('config', help='path to configuration file')
+parser.add_argument('--alphabet', default='en_US', help='alphabet to use, default=en_US')
+parser.add_argument('--batch-size', dest='batch_size', default=100, type=int, help='app ids per update check request, default=100')
+parser.add_argument('--rate', default=1/3.0, type=float, help='update check requests per second, default=0.33')
+parser.add_argument('--sleep', default=60, type=float, help='time to sleep in seconds in between passes over the app ids, default=60')
+
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	config = {}
+	with open(args.config, 'r') as f:
+		config = json.loads(f.read())
+
+	app_r = config_utils.redis_from_config(config, key='app_meta_config')
+	alphabet = AlphabetType[args.alphabet]
+
+	# Update checks draw from the same budget as package downloads, if configured
+	rate_limiters = rate_limiters_from_config(config, app_r)
+
+	checker = UpdateChecker(url=config['fetch_point'],
+							session=session_from_config(config, rate_limiters=rate_limiters),
+							alphabet=alphabet)
+	stage = VersionCheckStage(app_r,
+							  checker,
+							  alphabet=alphabet,
+							  batch_size=args.batch_size,
+							  rate_limiter=rate_limiters.get('fetch_point') or TokenBucket(rate=args.rate, capacity=1),
+							  revisit_policy=revisit_policy_from_config(config, app_r, alphabet),
+							  shards=shards_from_config(config))
+
+	while True:
+		checked, changed = stage.run()
+		logger.info('Checked %s due apps, %s need downloading' % (checked, changed))
+		logger.info('Sleeping for: %s seconds' % args.sleep)
+		time.sleep(args.sleep)